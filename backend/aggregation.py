@@ -0,0 +1,199 @@
+# backend/aggregation.py
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+class WeightedSumAccumulator:
+    """
+    Moyenne pondérée calculée au fil de l'eau : chaque client est ajouté à une somme
+    float64 préallouée puis oublié. Mémoire O(modèle) au lieu de O(clients x modèle),
+    contrairement à `flwr.server.strategy.aggregate.aggregate` qui garde toutes les listes.
+    """
+
+    def __init__(self):
+        self._sums: Optional[List[np.ndarray]] = None
+        self._scratch: Optional[List[np.ndarray]] = None
+        self._dtypes: Optional[List[np.dtype]] = None
+        self.total_weight = 0.0
+        self.count = 0
+
+    def add(self, ndarrays: List[np.ndarray], weight: float):
+        if self._sums is None:
+            self._sums = [np.zeros(a.shape, dtype=np.float64) for a in ndarrays]
+            self._scratch = [np.empty(a.shape, dtype=np.float64) for a in ndarrays]
+            self._dtypes = [a.dtype for a in ndarrays]
+        elif len(ndarrays) != len(self._sums) or any(a.shape != s.shape for a, s in zip(ndarrays, self._sums)):
+            raise ValueError("Client parameters do not match the shapes of the other clients.")
+        for total, scratch, array in zip(self._sums, self._scratch, ndarrays):
+            # scratch = array * weight puis total += scratch, sans tableau temporaire
+            np.multiply(array, weight, out=scratch)
+            total += scratch
+        self.total_weight += weight
+        self.count += 1
+
+    def result(self) -> List[np.ndarray]:
+        if not self.count or self.total_weight <= 0:
+            raise ValueError("Nothing to aggregate (no results or zero total weight).")
+        return [(total / self.total_weight).astype(dtype) for total, dtype in zip(self._sums, self._dtypes)]
+
+
+# --- Agrégateurs robustes (mises à jour empilées) ---
+#
+# Chaque client est aplati dans une ligne d'une matrice float32 contiguë (clients x paramètres).
+# Les réductions travaillent par blocs de colonnes répartis sur un pool de threads : NumPy
+# relâche le GIL pendant les tris / partitions / produits, les blocs avancent en parallèle.
+
+AGGREGATORS = ("mean", "median", "trimmed-mean", "krum")
+
+
+class Layout:
+    """Formes et types des tenseurs du modèle, pour passer de la liste de ndarrays au vecteur plat."""
+
+    def __init__(self, ndarrays: List[np.ndarray]):
+        self.shapes = [a.shape for a in ndarrays]
+        self.dtypes = [a.dtype for a in ndarrays]
+        self.offsets = np.cumsum([0] + [a.size for a in ndarrays]).tolist()
+        self.size = self.offsets[-1]
+
+    def flatten_into(self, ndarrays: List[np.ndarray], out: np.ndarray):
+        if len(ndarrays) != len(self.shapes) or any(a.shape != s for a, s in zip(ndarrays, self.shapes)):
+            raise ValueError("Client parameters do not match the shapes of the other clients.")
+        for array, start, end in zip(ndarrays, self.offsets, self.offsets[1:]):
+            out[start:end] = array.ravel()
+
+    def unflatten(self, flat: np.ndarray) -> List[np.ndarray]:
+        return [
+            flat[start:end].reshape(shape).astype(dtype)
+            for start, end, shape, dtype in zip(self.offsets, self.offsets[1:], self.shapes, self.dtypes)
+        ]
+
+
+class StackedUpdates:
+    """Mises à jour d'un round, une ligne par client, dans une matrice préallouée."""
+
+    def __init__(self, engine: "AggregationEngine", capacity: int):
+        self.engine = engine
+        self.capacity = capacity
+        self._layout: Optional[Layout] = None
+        self._matrix: Optional[np.ndarray] = None
+        self._weights = np.zeros(capacity, dtype=np.float64)
+        self.total_weight = 0.0
+        self.count = 0
+
+    def add(self, ndarrays: List[np.ndarray], weight: float):
+        if self._layout is None:
+            self._layout = Layout(ndarrays)
+            self._matrix = np.empty((self.capacity, self._layout.size), dtype=np.float32)
+        if self.count >= self.capacity:
+            raise ValueError(f"More updates than the {self.capacity} expected for this round.")
+        self._layout.flatten_into(ndarrays, self._matrix[self.count])
+        self._weights[self.count] = weight
+        self.total_weight += weight
+        self.count += 1
+
+    def result(self) -> List[np.ndarray]:
+        if not self.count or self.total_weight <= 0:
+            raise ValueError("Nothing to aggregate (no results or zero total weight).")
+        flat = self.engine.reduce(self._matrix[:self.count], self._weights[:self.count])
+        return self._layout.unflatten(flat)
+
+
+class AggregationEngine:
+    """
+    - mean : moyenne pondérée par num_examples (FedAvg), en flux via WeightedSumAccumulator
+    - median : médiane coordonnée par coordonnée
+    - trimmed-mean : moyenne coordonnée par coordonnée sans les `trim_ratio` plus basses / plus hautes
+    - krum : la mise à jour la plus proche de ses n - f - 2 voisines (tolère `krum_f` clients malveillants)
+    Les agrégateurs robustes ignorent les poids (num_examples x pondération de retard) : un client ne doit
+    pas pouvoir peser plus en gonflant num_examples, et une mise à jour tardive y compte comme les autres
+    (seul `--max-staleness` les écarte).
+    """
+
+    def __init__(self, method: str = "mean", trim_ratio: float = 0.1, krum_f: int = 1,
+                 threads: Optional[int] = None, chunk_size: int = 1 << 16):
+        if method not in AGGREGATORS:
+            raise ValueError(f"Unknown aggregator '{method}' (expected one of {', '.join(AGGREGATORS)}).")
+        if not 0.0 <= trim_ratio < 0.5:
+            raise ValueError("trim_ratio must be in [0, 0.5).")
+        if krum_f < 0:
+            raise ValueError("krum_f must be >= 0.")
+        self.method = method
+        self.trim_ratio = trim_ratio
+        self.krum_f = krum_f
+        self.chunk_size = chunk_size
+        self.threads = threads or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="aggregation") if self.threads > 1 else None
+        self.last_selected: Optional[int] = None  # ligne retenue par Krum au dernier round
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def new_round(self, capacity: int):
+        """Accumulateur pour un round d'au plus `capacity` clients."""
+        if self.method == "mean":
+            return WeightedSumAccumulator()
+        return StackedUpdates(self, capacity)
+
+    def aggregate(self, updates: List[Tuple[List[np.ndarray], float]]) -> List[np.ndarray]:
+        accumulator = self.new_round(len(updates))
+        for ndarrays, weight in updates:
+            accumulator.add(ndarrays, weight)
+        return accumulator.result()
+
+    # --- Réductions sur la matrice empilée ---
+
+    def reduce(self, matrix: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        if self.method == "krum":
+            return self._krum(matrix)
+        # "mean" n'empile pas : WeightedSumAccumulator fait la somme pondérée au fil de l'eau
+        out = np.empty(matrix.shape[1], dtype=np.float32)
+        kernel = {
+            "median": self._median_chunk,
+            "trimmed-mean": self._trimmed_mean_chunk,
+        }[self.method]
+        self._map_chunks(matrix.shape[1], lambda start, end: kernel(matrix[:, start:end], weights, out[start:end]))
+        return out
+
+    def _map_chunks(self, size: int, fn):
+        bounds = [(start, min(start + self.chunk_size, size)) for start in range(0, size, self.chunk_size)]
+        if self._pool is None or len(bounds) == 1:
+            return [fn(start, end) for start, end in bounds]
+        return list(self._pool.map(lambda b: fn(*b), bounds))
+
+    @staticmethod
+    def _median_chunk(chunk: np.ndarray, weights: np.ndarray, out: np.ndarray):
+        np.median(chunk, axis=0, out=out)
+
+    def _trimmed_mean_chunk(self, chunk: np.ndarray, weights: np.ndarray, out: np.ndarray):
+        n = chunk.shape[0]
+        k = int(self.trim_ratio * n)
+        if k == 0:
+            np.mean(chunk, axis=0, out=out)
+            return
+        # Seuls les rangs k..n-k-1 comptent : partition plutôt qu'un tri complet
+        part = np.partition(chunk, (k, n - k - 1), axis=0)
+        np.mean(part[k:n - k], axis=0, out=out)
+
+    def _krum(self, matrix: np.ndarray) -> np.ndarray:
+        n, f = matrix.shape[0], self.krum_f
+        if n < 2 * f + 3:
+            raise ValueError(f"Krum with f={f} needs at least {2 * f + 3} clients, got {n}.")
+
+        # ||a - b||² = ||a||² + ||b||² - 2 a·b, sommé bloc par bloc (en float64)
+        def partial(start, end):
+            chunk = matrix[:, start:end].astype(np.float64)
+            gram = chunk @ chunk.T
+            norms = np.diag(gram)
+            return norms[:, None] + norms[None, :] - 2.0 * gram
+
+        distances = np.maximum(sum(self._map_chunks(matrix.shape[1], partial)), 0.0)
+        np.fill_diagonal(distances, np.inf)
+        neighbours = n - f - 2
+        scores = np.sort(distances, axis=1)[:, :neighbours].sum(axis=1)
+        self.last_selected = int(np.argmin(scores))
+        return matrix[self.last_selected].copy()
@@ -0,0 +1,236 @@
+# backend/attack_retention.py
+
+import argparse
+import csv
+import gzip
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+from sqlalchemy import delete, select, text
+from sqlalchemy.orm import Session
+from main import AttackLog, SessionLocal, hour_bucket, rebuild_attack_rollups
+
+# Partitions mensuelles : attack_logs_p2024_05 couvre [2024-05-01, 2024-06-01)
+PARTITION_PREFIX = "attack_logs_p"
+DEFAULT_PARTITION = "attack_logs_default"
+RETENTION_DAYS = int(os.getenv("ATTACK_LOG_RETENTION_DAYS", "90"))
+PARTITION_MONTHS_AHEAD = int(os.getenv("ATTACK_LOG_PARTITION_MONTHS_AHEAD", "3"))
+DELETE_CHUNK_SIZE = 5000
+
+
+def month_start(ts: datetime) -> datetime:
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: datetime, n: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + n
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"{PARTITION_PREFIX}{month:%Y_%m}"
+
+
+def is_postgres(db: Session) -> bool:
+    return db.get_bind().dialect.name == "postgresql"
+
+
+def is_partitioned(db: Session) -> bool:
+    if not is_postgres(db):
+        return False
+    return db.execute(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('attack_logs')"
+    )).first() is not None
+
+
+def list_partitions(db: Session) -> List[Tuple[str, datetime]]:
+    """Partitions mensuelles existantes (nom, début du mois), hors partition par défaut."""
+    names = db.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass('attack_logs')"
+    )).scalars()
+    partitions = []
+    for name in names:
+        if name.startswith(PARTITION_PREFIX):
+            partitions.append((name, datetime.strptime(name[len(PARTITION_PREFIX):], "%Y_%m")))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def create_partition(db: Session, month: datetime) -> bool:
+    """
+    Crée la partition du mois si elle manque. Les lignes de ce mois déjà tombées dans la
+    partition par défaut (partition créée en retard) y sont déplacées, sinon PostgreSQL refuse.
+    """
+    name = partition_name(month)
+    if db.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar() is not None:
+        return False
+    bounds = {"start": month, "end": add_months(month, 1)}
+    db.execute(text(f"ALTER TABLE attack_logs DETACH PARTITION {DEFAULT_PARTITION}"))
+    db.execute(text(
+        f"CREATE TABLE {name} PARTITION OF attack_logs "
+        f"FOR VALUES FROM ('{bounds['start']:%Y-%m-%d}') TO ('{bounds['end']:%Y-%m-%d}')"
+    ))
+    db.execute(text(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE \"timestamp\" >= :start AND \"timestamp\" < :end RETURNING *) "
+        f"INSERT INTO attack_logs SELECT * FROM moved"
+    ), bounds)
+    db.execute(text(f"ALTER TABLE attack_logs ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    return True
+
+
+def ensure_partitions(db: Session, months_ahead: int = PARTITION_MONTHS_AHEAD) -> List[str]:
+    """Crée les partitions du mois courant et des `months_ahead` mois suivants."""
+    created = []
+    current = month_start(datetime.utcnow())
+    for n in range(months_ahead + 1):
+        month = add_months(current, n)
+        if create_partition(db, month):
+            created.append(partition_name(month))
+    return created
+
+
+def partition_attack_logs(db: Session, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """
+    Migration unique (PostgreSQL) : attack_logs devient une table partitionnée par mois
+    (RANGE sur timestamp) + une partition par défaut. À lancer ingestion arrêtée.
+    """
+    legacy = "attack_logs_legacy"
+    db.execute(text(f"ALTER TABLE attack_logs RENAME TO {legacy}"))
+    sequence = db.execute(text(f"SELECT pg_get_serial_sequence('{legacy}', 'id')")).scalar()
+    db.execute(text(f"UPDATE {legacy} SET \"timestamp\" = now() AT TIME ZONE 'utc' WHERE \"timestamp\" IS NULL"))
+    db.execute(text(
+        f"CREATE TABLE attack_logs (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE (\"timestamp\")"
+    ))
+    db.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF attack_logs DEFAULT"))
+
+    oldest = db.execute(text(f"SELECT min(\"timestamp\") FROM {legacy}")).scalar()
+    month = month_start(oldest or datetime.utcnow())
+    last = add_months(month_start(datetime.utcnow()), months_ahead)
+    while month <= last:
+        create_partition(db, month)
+        month = add_months(month, 1)
+
+    db.execute(text(f"INSERT INTO attack_logs SELECT * FROM {legacy}"))
+    if sequence:
+        # La séquence appartient à l'ancienne colonne : elle serait supprimée avec elle
+        db.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY attack_logs.id"))
+    db.execute(text(f"DROP TABLE {legacy}"))
+    # La clé primaire d'une table partitionnée doit contenir la clé de partition
+    db.execute(text("ALTER TABLE attack_logs ADD PRIMARY KEY (id, \"timestamp\")"))
+    for index in AttackLog.__table__.indexes:
+        index.create(bind=db.connection())
+
+
+def archive_rows(db: Session, since: Optional[datetime], until: datetime, archive_dir: str) -> str:
+    """Écrit les logs de [since, until) dans un CSV gzip, lu par paquets (curseur serveur)."""
+    os.makedirs(archive_dir, exist_ok=True)
+    label = f"{since:%Y%m%d%H}" if since else "start"
+    path = os.path.join(archive_dir, f"attack_logs_{label}_{until:%Y%m%d%H}.csv.gz")
+    table = AttackLog.__table__
+    statement = select(table).where(table.c.timestamp < until)
+    if since:
+        statement = statement.where(table.c.timestamp >= since)
+    result = db.execute(statement.order_by(table.c.timestamp).execution_options(yield_per=DELETE_CHUNK_SIZE))
+    with gzip.open(path, "wt", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(result.keys())
+        for rows in result.partitions():
+            writer.writerows(rows)
+    return path
+
+
+def drop_expired_partitions(db: Session, cutoff: datetime, archive_dir: Optional[str]) -> List[str]:
+    """Supprime (après compaction en rollups, et archivage éventuel) les partitions entièrement avant `cutoff`."""
+    dropped = []
+    for name, month in list_partitions(db):
+        end = add_months(month, 1)
+        if end > cutoff:
+            break
+        rebuild_attack_rollups(db, since=month, until=end)
+        if archive_dir:
+            print(f"  -> archived {name} to {archive_rows(db, month, end, archive_dir)}")
+        db.execute(text(f"ALTER TABLE attack_logs DETACH PARTITION {name}"))
+        db.execute(text(f"DROP TABLE {name}"))
+        db.commit()
+        dropped.append(name)
+    return dropped
+
+
+def delete_expired_rows(db: Session, cutoff: datetime, archive_dir: Optional[str]) -> int:
+    """Table non partitionnée : compaction puis DELETE par petits paquets (verrous et WAL courts)."""
+    cutoff = hour_bucket(cutoff)
+    oldest = db.query(AttackLog.timestamp).order_by(AttackLog.timestamp).limit(1).scalar()
+    if oldest is None or oldest >= cutoff:
+        return 0
+    # Les heures avant `oldest` ont déjà été compactées par un passage précédent
+    rebuild_attack_rollups(db, since=oldest, until=cutoff)
+    if archive_dir:
+        print(f"  -> archived to {archive_rows(db, hour_bucket(oldest), cutoff, archive_dir)}")
+    db.commit()
+
+    deleted = 0
+    while True:
+        chunk = select(AttackLog.id).where(AttackLog.timestamp < cutoff).limit(DELETE_CHUNK_SIZE)
+        count = db.execute(delete(AttackLog).where(AttackLog.id.in_(chunk))).rowcount
+        db.commit()
+        deleted += count
+        if count < DELETE_CHUNK_SIZE:
+            return deleted
+
+
+def run(command: str, keep_days: int, months_ahead: int, archive_dir: Optional[str]):
+    """
+    Command-line utility for attack_logs storage maintenance.
+      partition  convert attack_logs to monthly partitions (PostgreSQL, run once, ingestion stopped)
+      ensure     create upcoming monthly partitions (run daily, e.g. from cron)
+      retention  compact old rows into attack_rollups, optionally archive them, then drop them
+    """
+    db: Session = SessionLocal()
+    print(f"--- Attack Logs Maintenance: {command} ---")
+
+    try:
+        if command == "partition":
+            if not is_postgres(db):
+                print("\n❌ Native partitioning requires PostgreSQL; use 'retention' for chunked deletes.")
+                return
+            if is_partitioned(db):
+                print("\n✅ attack_logs is already partitioned.")
+                return
+            partition_attack_logs(db, months_ahead)
+            db.commit()
+            print(f"\n✅ attack_logs partitioned: {len(list_partitions(db))} monthly partitions.")
+
+        elif command == "ensure":
+            if not is_partitioned(db):
+                print("\n❌ attack_logs is not partitioned (run 'partition' first).")
+                return
+            created = ensure_partitions(db, months_ahead)
+            db.commit()
+            print(f"\n✅ Created partitions: {', '.join(created) or 'none needed'}")
+
+        elif command == "retention":
+            cutoff = datetime.utcnow() - timedelta(days=keep_days)
+            if is_partitioned(db):
+                dropped = drop_expired_partitions(db, cutoff, archive_dir)
+                print(f"\n✅ Dropped partitions: {', '.join(dropped) or 'none expired'}")
+            else:
+                deleted = delete_expired_rows(db, cutoff, archive_dir)
+                print(f"\n✅ Deleted {deleted} attack logs older than {hour_bucket(cutoff)}.")
+
+    except Exception as e:
+        db.rollback()
+        print(f"\n❌ Error during '{command}': {e}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Partitioning and retention for attack_logs.")
+    parser.add_argument("command", choices=["partition", "ensure", "retention"])
+    parser.add_argument("--keep-days", type=int, default=RETENTION_DAYS,
+                        help="Raw attack logs older than this are compacted into rollups and removed.")
+    parser.add_argument("--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD,
+                        help="Monthly partitions to create in advance.")
+    parser.add_argument("--archive-dir", default=None,
+                        help="Write expired rows to gzipped CSV files here before removing them.")
+    args = parser.parse_args()
+    run(args.command, args.keep_days, args.months_ahead, args.archive_dir)
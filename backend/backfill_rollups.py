@@ -0,0 +1,34 @@
+# backend/backfill_rollups.py
+
+import argparse
+from datetime import datetime
+from sqlalchemy.orm import Session
+from main import SessionLocal, rebuild_attack_rollups
+
+def backfill_rollups(since: datetime = None):
+    """
+    Command-line utility to rebuild attack_rollups from attack_logs. Without `since`, only the
+    buckets from the oldest remaining log onwards are rebuilt (older rollups are kept).
+    Run it with ingestion stopped: rows written during the rebuild would be counted twice.
+    """
+    db: Session = SessionLocal()
+    print("--- Rebuild Attack Rollups ---")
+
+    try:
+        rollup_rows, total = rebuild_attack_rollups(db, since=since)
+        db.commit()
+        print(f"\n✅ Rebuilt {rollup_rows} rollup rows covering {total} attacks.")
+
+    except Exception as e:
+        db.rollback()
+        print(f"\n❌ Error rebuilding rollups: {e}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild attack_rollups from attack_logs.")
+    parser.add_argument("--since", type=datetime.fromisoformat, default=None,
+                        help="Only rebuild buckets from this UTC date (e.g. 2024-05-01T00:00). "
+                             "Default: the oldest attack log still stored.")
+    args = parser.parse_args()
+    backfill_rollups(args.since)
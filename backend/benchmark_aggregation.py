@@ -0,0 +1,74 @@
+# backend/benchmark_aggregation.py
+
+import argparse
+import time
+
+import numpy as np
+
+from aggregation import AGGREGATORS, AggregationEngine
+
+try:
+    from flwr.server.strategy.aggregate import aggregate as flwr_aggregate
+except Exception:
+    flwr_aggregate = None
+
+
+def model_shapes(use_model: bool, params: int):
+    """Formes des tenseurs : celles du vrai modèle (TensorFlow requis) ou des couches synthétiques."""
+    if use_model:
+        from model_definition import create_model
+        return [w.shape for w in create_model().get_weights()]
+    width = int(np.sqrt(params / 4))
+    return [(width, width), (width,), (width, width * 2), (width * 2,), (width * 2, width), (width,), (width, 10), (10,)]
+
+
+def timed(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_benchmark(clients: int, params: int, use_model: bool, threads: int, repeat: int):
+    """
+    Command-line utility to compare the time of one aggregation step for each aggregator
+    against Flower's `aggregate` (the path FedAvg used before).
+    """
+    rng = np.random.default_rng(0)
+    shapes = model_shapes(use_model, params)
+    updates = [([rng.standard_normal(shape).astype(np.float32) for shape in shapes], int(rng.integers(100, 1000)))
+               for _ in range(clients)]
+    total = sum(int(np.prod(shape)) for shape in shapes)
+    print(f"--- Aggregation benchmark: {clients} clients x {total:,} parameters, {threads} threads ---")
+
+    baseline = None
+    if flwr_aggregate is not None:
+        baseline = timed(lambda: flwr_aggregate(updates), repeat)
+        print(f"{'flwr aggregate':<16} {baseline * 1000:9.1f} ms")
+    else:
+        print("⚠️ flwr is not installed: no baseline.")
+
+    for method in AGGREGATORS:
+        engine = AggregationEngine(method, krum_f=max(0, min(1, (clients - 3) // 2)), threads=threads)
+        try:
+            elapsed = timed(lambda: engine.aggregate(updates), repeat)
+        except ValueError as e:
+            print(f"{method:<16} ❌ {e}")
+            continue
+        finally:
+            engine.close()
+        speedup = f"  (x{baseline / elapsed:.2f} vs flwr)" if baseline else ""
+        print(f"{method:<16} {elapsed * 1000:9.1f} ms{speedup}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the server aggregation kernels.")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--params", type=int, default=2_000_000, help="Approximate parameter count of the synthetic model.")
+    parser.add_argument("--model", action="store_true", help="Use the real model shapes from model_definition (needs TensorFlow).")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run_benchmark(args.clients, args.params, args.model, args.threads or AggregationEngine().threads, args.repeat)
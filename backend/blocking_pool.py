@@ -0,0 +1,90 @@
+# backend/blocking_pool.py
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+
+class BlockingPool:
+    """
+    Pool de threads borné pour exécuter du code bloquant (GeoIP, SQLAlchemy synchrone)
+    depuis des handlers async sans bloquer la boucle d'événements.
+
+    Au-delà de `max_workers + max_pending` tâches en vol, les appelants attendent
+    (sans bloquer la boucle) qu'une place se libère : c'est la contre-pression.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_pending: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = asyncio.Semaphore(max_workers + max_pending)
+        self._lock = threading.Lock()
+        self.queued = 0              # soumis au pool, pas encore démarrés
+        self.waiting_for_slot = 0    # bloqués par la contre-pression
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        self.waiting_for_slot += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting_for_slot -= 1
+        try:
+            with self._lock:
+                self.queued += 1
+            call = functools.partial(self._call, time.monotonic(), fn, args, kwargs)
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        finally:
+            self._slots.release()
+
+    def _call(self, submitted_at: float, fn: Callable, args: tuple, kwargs: dict) -> Any:
+        started_at = time.monotonic()
+        wait = started_at - submitted_at
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            elapsed = time.monotonic() - started_at
+            with self._lock:
+                self.active -= 1
+                self.total_run += elapsed
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            done = self.completed + self.failed
+            return {
+                "name": self.name,
+                "max_workers": self.max_workers,
+                "max_pending": self.max_pending,
+                "queue_depth": self.queued,
+                "waiting_for_slot": self.waiting_for_slot,
+                "active": self.active,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_wait_ms": round(1000 * self.total_wait / done, 3) if done else 0.0,
+                "max_wait_ms": round(1000 * self.max_wait, 3),
+                "avg_run_ms": round(1000 * self.total_run / done, 3) if done else 0.0,
+            }
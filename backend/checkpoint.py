@@ -0,0 +1,77 @@
+# backend/checkpoint.py
+
+import os
+import queue
+import tempfile
+import threading
+from typing import List, Optional
+
+import numpy as np
+
+
+def atomic_write(path: str, write):
+    """Écrit via un fichier temporaire du même répertoire, fsync, puis os.replace (atomique)."""
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class CheckpointWriter:
+    """
+    Enregistre les poids agrégés dans le registre de modèles depuis un thread dédié :
+    `submit` ne fait que mettre les tableaux en file, la sérialisation et l'I/O disque
+    sortent du chemin critique du round. Aucun modèle Keras n'est instancié.
+    """
+
+    def __init__(self, registry, keep: int = 5):
+        self.registry = registry
+        self.keep = keep
+        self._queue: "queue.Queue" = queue.Queue()
+        self._versions = {}  # server_round -> version enregistrée
+        self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, server_round: int, ndarrays: List[np.ndarray]):
+        self._queue.put((self._register, (server_round, ndarrays)))
+
+    def update_metrics(self, server_round: int, accuracy: Optional[float], loss: Optional[float]):
+        """Métriques d'évaluation du round, connues après `submit` : traitées dans le même ordre."""
+        self._queue.put((self._update_metrics, (server_round, accuracy, loss)))
+
+    def close(self):
+        """Attend que les checkpoints en file soient écrits."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _register(self, server_round: int, ndarrays: List[np.ndarray]):
+        meta = self.registry.register(server_round, ndarrays)
+        self._versions[server_round] = meta["version"]
+        self.registry.prune(self.keep)
+        print(f"💾 Saved global weights for round {server_round} as model version {meta['version']}")
+
+    def _update_metrics(self, server_round: int, accuracy: Optional[float], loss: Optional[float]):
+        version = self._versions.pop(server_round, None)
+        if version is not None:
+            self.registry.update_metadata(version, accuracy=accuracy, loss=loss)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            task, args = item
+            try:
+                task(*args)
+            except Exception as e:
+                print(f"❌ FAILED to save checkpoint for round {args[0]}. Error: {e}")
@@ -7,6 +7,7 @@ import argparse, os, configparser, requests, time, threading, random, socket
 from typing import Optional
 from sklearn.model_selection import train_test_split
 from model_definition import create_model
+from update_codec import CODECS, UpdateEncoder
 
 # --- Configuration Globale ---
 API_URL = "http://127.0.0.1:8000"
@@ -77,41 +78,132 @@ def generate_local_data(num_samples=1000):
 
 
 # --- Client Flower ---
+OPTIMIZER_STATE_POLICIES = ("keep", "reset", "persist")
+
+
 class CnnLstmClient(fl.client.NumPyClient):
-    def __init__(self, model, x_train, y_train, x_val, y_val):
+    """
+    Le modèle est compilé une seule fois (dans main) : les pas d'entraînement / d'évaluation
+    sont des tf.function tracées au premier round puis réutilisées, sur des tf.data mis en cache.
+
+    État de l'optimiseur (moments d'Adam) entre les rounds, selon `optimizer_state` :
+    - keep : conservé en mémoire
+    - reset (défaut) : remis à zéro avant chaque fit, comme la recompilation de chaque round d'avant
+    - persist : conservé et sauvegardé dans `state_dir` (tf.train.Checkpoint), restauré au démarrage
+    """
+
+    def __init__(self, model, x_train, y_train, x_val, y_val, encoder: Optional[UpdateEncoder] = None,
+                 optimizer_state: str = "reset", state_dir: Optional[str] = None, epochs: int = 2, batch_size: int = 32):
+        if optimizer_state not in OPTIMIZER_STATE_POLICIES:
+            raise ValueError(f"Unknown optimizer state policy '{optimizer_state}'.")
+        if optimizer_state == "persist" and not state_dir:
+            raise ValueError("optimizer_state='persist' needs a state_dir.")
         self.model = model
-        self.x_train, self.y_train = x_train, y_train
-        self.x_val, self.y_val = x_val, y_val
+        self.num_train, self.num_val = len(x_train), len(x_val)
+        # Si défini : on envoie un delta compressé par rapport aux poids globaux du round
+        self.encoder = encoder
+        self.optimizer_state = optimizer_state
+        self.epochs = epochs
+        self.optimizer = model.optimizer
+        self.loss_fn = tf.keras.losses.SparseCategoricalCrossentropy()
+        self.loss_metric = tf.keras.metrics.Mean()
+        self.accuracy_metric = tf.keras.metrics.SparseCategoricalAccuracy()
+
+        self.train_ds = (
+            tf.data.Dataset.from_tensor_slices((x_train.astype(np.float32), y_train.astype(np.int64)))
+            .cache().shuffle(len(x_train), reshuffle_each_iteration=True).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+        )
+        self.val_ds = (
+            tf.data.Dataset.from_tensor_slices((x_val.astype(np.float32), y_val.astype(np.int64)))
+            .batch(batch_size).cache().prefetch(tf.data.AUTOTUNE)
+        )
+        # Signature fixe (taille de batch libre) : pas de nouveau traçage pour le dernier batch incomplet
+        signature = [tf.TensorSpec((None, *x_train.shape[1:]), tf.float32), tf.TensorSpec((None,), tf.int64)]
+        self._train_step = tf.function(self._train_step_impl, input_signature=signature)
+        self._eval_step = tf.function(self._eval_step_impl, input_signature=signature)
+
+        self.checkpoint_manager = None
+        if optimizer_state == "persist":
+            checkpoint = tf.train.Checkpoint(optimizer=self.optimizer)
+            self.checkpoint_manager = tf.train.CheckpointManager(checkpoint, state_dir, max_to_keep=1)
+            if self.checkpoint_manager.latest_checkpoint:
+                # Restauration différée : les variables d'Adam sont créées au premier pas d'entraînement
+                checkpoint.restore(self.checkpoint_manager.latest_checkpoint)
+                print(f"✅ Optimizer state restored from {self.checkpoint_manager.latest_checkpoint}")
+
+    def _train_step_impl(self, x, y):
+        with tf.GradientTape() as tape:
+            predictions = self.model(x, training=True)
+            loss = self.loss_fn(y, predictions) + sum(self.model.losses)
+        gradients = tape.gradient(loss, self.model.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+        self.loss_metric.update_state(loss)
+        self.accuracy_metric.update_state(y, predictions)
+
+    def _eval_step_impl(self, x, y):
+        predictions = self.model(x, training=False)
+        self.loss_metric.update_state(self.loss_fn(y, predictions))
+        self.accuracy_metric.update_state(y, predictions)
+
+    def _run(self, step, dataset):
+        self.loss_metric.reset_state()
+        self.accuracy_metric.reset_state()
+        for x, y in dataset:
+            step(x, y)
+        return float(self.loss_metric.result()), float(self.accuracy_metric.result())
+
+    def _reset_optimizer(self):
+        for variable in self.optimizer.variables:
+            variable.assign(tf.zeros_like(variable))
 
     def get_parameters(self, config):
         return self.model.get_weights()
 
     def fit(self, parameters, config):
         try:
+            timings = {}
+            started = time.perf_counter()
             self.model.set_weights(parameters)
-            self.model.compile(
-                optimizer="adam",
-                loss="sparse_categorical_crossentropy",
-                metrics=["accuracy"]
-            )
-            self.model.fit(self.x_train, self.y_train, epochs=2, batch_size=32, verbose=1)
+            if self.optimizer_state == "reset":
+                self._reset_optimizer()
+            timings["time_set_weights"] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            for epoch in range(self.epochs):
+                loss, accuracy = self._run(self._train_step, self.train_ds)
+                print(f"   Epoch {epoch + 1}/{self.epochs} — loss: {loss:.4f}, accuracy: {accuracy:.4f}")
+            timings["time_train"] = time.perf_counter() - started
+            if self.checkpoint_manager:
+                self.checkpoint_manager.save()
             print("✅ Local training round finished.")
-            return self.model.get_weights(), len(self.x_train), {}
+
+            started = time.perf_counter()
+            weights = self.model.get_weights()
+            timings["time_get_weights"] = time.perf_counter() - started
+            metrics = {}
+            if self.encoder and "server_round" in config:
+                started = time.perf_counter()
+                weights, metrics = self.encoder.encode(weights, parameters)
+                timings["time_encode"] = time.perf_counter() - started
+                metrics["base_round"] = int(config["server_round"])
+                print(f"📦 Update encoded ({metrics['codec']}): {metrics['bytes_encoded']} / {metrics['bytes_raw']} bytes, "
+                      f"reconstruction error {metrics['reconstruction_error']:.2e}")
+            print(f"⏱️ fit timings: {', '.join(f'{name[5:]}={value:.3f}s' for name, value in timings.items())}")
+            return weights, self.num_train, {**metrics, **timings}
         except Exception as e:
             print(f"❌ Error in fit(): {e}")
             return self.model.get_weights(), 0, {}
 
     def evaluate(self, parameters, config):
         try:
+            started = time.perf_counter()
             self.model.set_weights(parameters)
-            self.model.compile(
-                optimizer="adam",
-                loss="sparse_categorical_crossentropy",
-                metrics=["accuracy"]
-            )
-            loss, accuracy = self.model.evaluate(self.x_val, self.y_val, verbose=0)
-            print(f"📊 Evaluation result — Loss: {loss:.4f}, Accuracy: {accuracy:.4f}")
-            return float(loss), len(self.x_val), {"accuracy": float(accuracy)}
+            set_weights_time = time.perf_counter() - started
+            started = time.perf_counter()
+            loss, accuracy = self._run(self._eval_step, self.val_ds)
+            eval_time = time.perf_counter() - started
+            print(f"📊 Evaluation result — Loss: {loss:.4f}, Accuracy: {accuracy:.4f} ({eval_time:.3f}s)")
+            return loss, self.num_val, {"accuracy": accuracy, "time_set_weights": set_weights_time, "time_eval": eval_time}
         except Exception as e:
             print(f"❌ Error in evaluate(): {e}")
             return 0.0, 0, {"accuracy": 0.0}
@@ -123,6 +215,14 @@ def main():
     parser.add_argument("--client-id", type=int, required=True)
     parser.add_argument("--config", type=str, default="config.ini")
     parser.add_argument("--server-ip", type=str, default="127.0.0.1")
+    parser.add_argument("--update-codec", choices=["off", *CODECS], default="off",
+                        help="Send compressed weight deltas instead of full float32 weights.")
+    parser.add_argument("--topk", type=float, default=0.0,
+                        help="With --update-codec: fraction of delta entries to send (0 = all).")
+    parser.add_argument("--optimizer-state", choices=OPTIMIZER_STATE_POLICIES, default="reset",
+                        help="Optimizer state between rounds: reset every round (previous behaviour), keep in memory, or persist to disk.")
+    parser.add_argument("--state-dir", type=str, default=None,
+                        help="With --optimizer-state persist (default: optimizer_state/client_<id>).")
     args = parser.parse_args()
 
     print(f"--- Starting Client {args.client_id} (Config: {args.config}) ---")
@@ -154,14 +254,17 @@ def main():
         model = create_model()
         model.compile(optimizer="adam", loss="sparse_categorical_crossentropy", metrics=["accuracy"])
         print(model.summary())
-        print("✅ Model created and compiled (weights will come from server).")
+        print("✅ Model created and compiled once (weights will come from server).")
     except Exception as e:
         print(f"❌ Failed to create model: {e}")
         stop_event.set()
         bg_thread.join(1)
         return
 
-    client = CnnLstmClient(model, x_train, y_train, x_val, y_val)
+    encoder = UpdateEncoder(args.update_codec, args.topk) if args.update_codec != "off" else None
+    state_dir = args.state_dir or os.path.join("optimizer_state", f"client_{args.client_id}")
+    client = CnnLstmClient(model, x_train, y_train, x_val, y_val, encoder=encoder,
+                           optimizer_state=args.optimizer_state, state_dir=state_dir)
     print(f"Connecting to Flower server at {FLOWER_SERVER_ADDRESS}...")
     try:
         # Choisir automatiquement la bonne fonction
@@ -0,0 +1,111 @@
+# backend/create_indexes.py
+
+import argparse
+from typing import List
+from sqlalchemy import Index, text
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex
+from main import SessionLocal, dedupe_client_history, engine, index_presence_cache, missing_indexes
+
+# Nom PostgreSQL limité à 63 caractères
+MAX_IDENTIFIER = 63
+
+
+def is_postgres() -> bool:
+    return engine.dialect.name == "postgresql"
+
+
+def quote(name: str) -> str:
+    return engine.dialect.identifier_preparer.quote(name)
+
+
+def child_partitions(table_name: str) -> List[str]:
+    with engine.connect() as conn:
+        return list(conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:table) ORDER BY c.relname"
+        ), {"table": table_name}).scalars())
+
+
+def drop_invalid_index(conn, name: str):
+    """Un CREATE INDEX CONCURRENTLY interrompu laisse un index INVALID : on le supprime avant de recommencer."""
+    invalid = conn.execute(text(
+        "SELECT 1 FROM pg_index WHERE indexrelid = to_regclass(:name) AND NOT indisvalid"
+    ), {"name": name}).first()
+    if invalid:
+        print(f"   -> dropping invalid index {name} left by an interrupted build")
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {quote(name)}"))
+
+
+def create_index_concurrently(index: Index):
+    """
+    PostgreSQL : CREATE INDEX CONCURRENTLY, sans bloquer les écritures.
+    Table partitionnée (voir attack_retention.py) : index ON ONLY sur la table mère, construit
+    CONCURRENTLY sur chaque partition puis attaché ; il devient valide quand toutes le sont.
+    """
+    table = index.table.name
+    columns = ", ".join(quote(column.name) for column in index.columns)
+    unique = "UNIQUE " if index.unique else ""
+    # CONCURRENTLY est interdit dans une transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        partitions = child_partitions(table)
+        if not partitions:
+            drop_invalid_index(conn, index.name)
+            conn.execute(text(f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {quote(index.name)} ON {quote(table)} ({columns})"))
+            return
+        conn.execute(text(f"CREATE {unique}INDEX IF NOT EXISTS {quote(index.name)} ON ONLY {quote(table)} ({columns})"))
+        for partition in partitions:
+            child = f"{index.name}_{partition}"[:MAX_IDENTIFIER]
+            print(f"   -> {child}")
+            drop_invalid_index(conn, child)
+            conn.execute(text(f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {quote(child)} ON {quote(partition)} ({columns})"))
+            attached = conn.execute(text(
+                "SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(:child) AND inhparent = to_regclass(:parent)"
+            ), {"child": child, "parent": index.name}).first()
+            if not attached:
+                conn.execute(text(f"ALTER INDEX {quote(index.name)} ATTACH PARTITION {quote(child)}"))
+
+
+def create_indexes(dry_run: bool = False):
+    """
+    Command-line utility to build the indexes declared on attack_logs and client_history
+    that are missing from the database. Safe to run with the API up on PostgreSQL
+    (CONCURRENTLY); on SQLite the build is a plain CREATE INDEX.
+    """
+    db: Session = SessionLocal()
+    print("--- Create Missing Indexes ---")
+
+    try:
+        missing = missing_indexes(db)
+        if not missing:
+            print("\n✅ All indexes already exist.")
+            return
+        for index in missing:
+            print(f"{'Would create' if dry_run else 'Creating'} {index.name} on {index.table.name}...")
+            if dry_run:
+                continue
+            if index.name == "uq_client_history_client_round":
+                # Les doublons (client, round) enregistrés avant l'index empêcheraient sa création
+                removed = dedupe_client_history(db)
+                db.commit()
+                if removed:
+                    print(f"   -> removed {removed} duplicate client_history rows")
+            if is_postgres():
+                create_index_concurrently(index)
+            else:
+                with engine.begin() as conn:
+                    conn.execute(CreateIndex(index, if_not_exists=True))
+        index_presence_cache.clear()
+        if not dry_run:
+            print(f"\n✅ Created {len(missing)} indexes. API workers pick them up within 5 minutes.")
+    except Exception as e:
+        db.rollback()
+        print(f"\n❌ Error while creating indexes: {e}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build missing attack_logs / client_history indexes.")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the missing indexes.")
+    args = parser.parse_args()
+    create_indexes(args.dry_run)
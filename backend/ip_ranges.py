@@ -0,0 +1,95 @@
+# backend/ip_ranges.py
+import ipaddress
+from bisect import bisect_right
+from typing import Iterable, List, Optional, Tuple
+
+# Registres IANA "special-purpose" (RFC 6890 et mises à jour) + multicast.
+# Aucune de ces adresses n'a de sens dans une base GeoIP.
+PRIVATE_NETWORKS = [
+    "10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16",   # RFC 1918
+    "100.64.0.0/10",                                     # CGNAT (RFC 6598)
+    "127.0.0.0/8", "169.254.0.0/16",                     # loopback, link-local
+    "::1/128", "fc00::/7", "fe80::/10",                  # loopback, ULA, link-local
+]
+RESERVED_NETWORKS = [
+    # IPv4
+    "0.0.0.0/8", "192.0.0.0/24", "192.0.2.0/24", "192.31.196.0/24", "192.52.193.0/24",
+    "192.88.99.0/24", "192.175.48.0/24", "198.18.0.0/15", "198.51.100.0/24",
+    "203.0.113.0/24", "224.0.0.0/4", "240.0.0.0/4", "255.255.255.255/32",
+    # IPv6
+    "::/128", "64:ff9b::/96", "64:ff9b:1::/48", "100::/64", "2001::/23", "2001:db8::/32",
+    "2002::/16", "2620:4f:8000::/48", "3fff::/20", "5f00::/16", "ff00::/8",
+]
+
+# En cas de chevauchement, le label le plus prioritaire l'emporte.
+_PRIORITY = {"internal": 3, "private": 2, "reserved": 1}
+
+
+def parse_cidr_list(value: Optional[str]) -> List[str]:
+    """Transforme "10.20.0.0/16, 2001:db8:1::/48" en liste de CIDR."""
+    return [cidr.strip() for cidr in (value or "").split(",") if cidr.strip()]
+
+
+class _IntervalIndex:
+    """Intervalles d'entiers triés et disjoints, interrogés par bisect."""
+
+    def __init__(self, intervals: List[Tuple[int, int, str]]):
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        self.labels: List[str] = []
+        for start, end, label in self._flatten(intervals):
+            if self.labels and self.labels[-1] == label and self.ends[-1] + 1 == start:
+                self.ends[-1] = end
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+                self.labels.append(label)
+
+    @staticmethod
+    def _flatten(intervals: List[Tuple[int, int, str]]):
+        # Découpage en segments élémentaires : chaque segment prend le label le plus prioritaire
+        # parmi les blocs qui le couvrent. Fait une seule fois au démarrage.
+        bounds = sorted({start for start, _, _ in intervals} | {end + 1 for _, end, _ in intervals})
+        for low, high in zip(bounds, bounds[1:]):
+            covering = [label for start, end, label in intervals if start <= low and high - 1 <= end]
+            if covering:
+                yield low, high - 1, max(covering, key=_PRIORITY.__getitem__)
+
+    def lookup(self, value: int) -> Optional[str]:
+        i = bisect_right(self.starts, value) - 1
+        if i >= 0 and value <= self.ends[i]:
+            return self.labels[i]
+        return None
+
+
+class SpecialNetworkIndex:
+    """
+    Classe une adresse IPv4/IPv6 en "private", "reserved", "internal" (CIDR propres au
+    déploiement), "invalid" (chaîne illisible) ou None (adresse publique, à géolocaliser).
+    """
+
+    def __init__(self, extra_internal_cidrs: Iterable[str] = ()):
+        intervals = {4: [], 6: []}
+        for cidrs, label in ((PRIVATE_NETWORKS, "private"), (RESERVED_NETWORKS, "reserved"), (extra_internal_cidrs, "internal")):
+            for cidr in cidrs:
+                network = ipaddress.ip_network(cidr, strict=False)
+                intervals[network.version].append(
+                    (int(network.network_address), int(network.broadcast_address), label)
+                )
+        self._v4 = _IntervalIndex(intervals[4])
+        self._v6 = _IntervalIndex(intervals[6])
+
+    def classify(self, ip: str) -> Optional[str]:
+        try:
+            address = ipaddress.ip_address(ip.strip())
+        except ValueError:
+            return "invalid"
+        if address.version == 6:
+            if address.ipv4_mapped is not None:
+                # ::ffff:8.8.8.8 -> on classe l'adresse IPv4 sous-jacente
+                return self._v4.lookup(int(address.ipv4_mapped))
+            return self._v6.lookup(int(address))
+        return self._v4.lookup(int(address))
+
+    def is_special(self, ip: str) -> bool:
+        return self.classify(ip) is not None
@@ -2,6 +2,7 @@
 
 import random
 import os
+import csv
 import uuid
 import json
 import shutil
@@ -10,9 +11,12 @@ import asyncio
 import base64
 import io
 import time
+import threading
+import tempfile
+import hashlib
 from datetime import datetime, timedelta
 from contextlib import asynccontextmanager
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Set, NamedTuple
 from urllib.parse import urlencode
 from fastapi import status as http_status
 import enum
@@ -29,14 +33,15 @@ from fastapi import (
     File,
     UploadFile,
     Response,
+    Query,
 )
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from passlib.context import CryptContext
 from jose import JWTError, jwt
-from pydantic import BaseModel, EmailStr, ConfigDict
+from pydantic import BaseModel, EmailStr, ConfigDict, ValidationError
 
 
 from sqlalchemy import (
@@ -50,8 +55,18 @@ from sqlalchemy import (
     Text,
     Boolean,
     func, 
-    UniqueConstraint 
+    UniqueConstraint,
+    insert,
+    update,
+    bindparam,
+    or_,
+    and_,
+    case,
+    Index,
+    select,
+    inspect as sa_inspect,
 )
+from sqlalchemy.dialects import postgresql as pg_dialect, sqlite as sqlite_dialect
 from datetime import datetime, UTC
 from sqlalchemy.orm import declarative_base,sessionmaker, Session, relationship, selectinload
 #from sqlalchemy.ext.declarative import declarative_base
@@ -83,9 +98,19 @@ try:
     import flwr as fl
 except Exception:
     fl = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except Exception:
+    pa = pq = None
 
 # Local model factory
 from model_definition import create_model
+from ttl_cache import LRUTTLCache
+from ip_ranges import SpecialNetworkIndex, parse_cidr_list
+from blocking_pool import BlockingPool
+from model_registry import ModelRegistry
+from ws_broker import Broker, create_broker
 import subprocess
 import sys
 from typing import List, Optional, Dict, Tuple # <<< Assurez-vous que Tuple est importé
@@ -101,6 +126,13 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "super-secret-dev-key")
 ALGORITHM = "HS256"
 GEOIP_DB_PATH = os.getenv("GEOIP_DB_PATH", "geoip_db/GeoLite2-City.mmdb")
+GEOIP_CACHE_SIZE = int(os.getenv("GEOIP_CACHE_SIZE", "50000"))
+GEOIP_CACHE_TTL = float(os.getenv("GEOIP_CACHE_TTL", "86400"))
+GEOIP_NEGATIVE_CACHE_TTL = float(os.getenv("GEOIP_NEGATIVE_CACHE_TTL", "3600"))
+DEVICE_CACHE_SIZE = int(os.getenv("DEVICE_CACHE_SIZE", "100000"))
+DEVICE_CACHE_TTL = float(os.getenv("DEVICE_CACHE_TTL", "30"))
+# Réseaux "internes" propres au déploiement, jamais géolocalisés (ex: "10.20.0.0/16,2001:db8:1::/48")
+INTERNAL_CIDRS = parse_cidr_list(os.getenv("INTERNAL_CIDRS"))
 try:
     print(f"Attempting to load GeoIP database from: {GEOIP_DB_PATH}")
     geoip_reader = geoip2.database.Reader(GEOIP_DB_PATH)
@@ -150,6 +182,12 @@ try:
 except Exception:
     geoip_reader = None
 
+# Le trafic d'attaque vient surtout d'un petit nombre d'IP qui se répètent :
+# on garde les résultats GeoIP en mémoire (y compris les "pas de résultat").
+geoip_cache = LRUTTLCache(GEOIP_CACHE_SIZE, GEOIP_CACHE_TTL, negative_ttl=GEOIP_NEGATIVE_CACHE_TTL)
+# Index des plages privées / réservées (IANA) + INTERNAL_CIDRS, construit une seule fois
+special_networks = SpecialNetworkIndex(INTERNAL_CIDRS)
+
 
 
 
@@ -252,6 +290,32 @@ class AttackLog(Base):
     longitude = Column(Float, nullable=True)
     city = Column(String, nullable=True)
     country = Column(String, nullable=True)
+    # Index composites pour la pagination keyset (timestamp, id) de l'historique, par filtre
+    __table_args__ = (
+        Index("ix_attack_logs_ts_id", "timestamp", "id"),
+        Index("ix_attack_logs_device_ts_id", "device_api_key", "timestamp", "id"),
+        Index("ix_attack_logs_type_ts_id", "attack_type", "timestamp", "id"),
+        Index("ix_attack_logs_country_ts_id", "country", "timestamp", "id"),
+    )
+
+
+class AttackRollup(Base):
+    """
+    Compteurs pré-agrégés par appareil x type d'attaque x heure, mis à jour à l'ingestion.
+    Les statistiques des dashboards sont lues ici au lieu de scanner attack_logs.
+    """
+    __tablename__ = "attack_rollups"
+    id = Column(Integer, primary_key=True)
+    # "" pour les rapports sans clé API (un NULL casserait la contrainte d'unicité)
+    device_api_key = Column(String, nullable=False, default="")
+    attack_type = Column(String, nullable=False)
+    bucket = Column(DateTime, nullable=False) # début de l'heure (UTC)
+    count = Column(Integer, nullable=False, default=0)
+    last_seen = Column(DateTime, nullable=False)
+    __table_args__ = (
+        UniqueConstraint("device_api_key", "attack_type", "bucket", name="uq_attack_rollups_key_type_bucket"),
+        Index("ix_attack_rollups_bucket", "bucket"),
+    )
 
 
 class Client(Base):
@@ -267,7 +331,7 @@ class Client(Base):
     owner = relationship("User")
 
 class ClientHistory(Base):
-    __tablename__="client_history";id=Column(Integer,primary_key=True);client_id=Column(Integer,ForeignKey("clients.id"));server_round=Column(Integer);accuracy=Column(Float);loss=Column(Float);timestamp=Column(DateTime,default=datetime.utcnow);client=relationship("Client",back_populates="history_records")
+    __tablename__="client_history";id=Column(Integer,primary_key=True);client_id=Column(Integer,ForeignKey("clients.id"));server_round=Column(Integer);accuracy=Column(Float);loss=Column(Float);timestamp=Column(DateTime,default=datetime.utcnow);client=relationship("Client",back_populates="history_records");__table_args__=(Index("uq_client_history_client_round","client_id","server_round",unique=True),)
 
 class Payment(Base):
     __tablename__="payments";id=Column(Integer,primary_key=True);user_id=Column(Integer,ForeignKey("users.id"));stripe_payment_intent_id=Column(String,unique=True);amount=Column(Integer);currency=Column(String);status=Column(String);created_at=Column(DateTime,default=datetime.utcnow);user=relationship("User")
@@ -488,6 +552,16 @@ class AttackReport(BaseModel):
     attack_type:str
     confidence:float
     api_key: str
+class BulkReportItemStatus(BaseModel):
+    index: int
+    status: str # accepted, invalid
+    id: Optional[int] = None
+    error: Optional[str] = None
+
+class BulkReportResult(BaseModel):
+    accepted: int
+    rejected: int
+    items: List[BulkReportItemStatus]
 class AttackLogPublic(BaseModel):id:int;timestamp:datetime;source_ip:str;attack_type:str;confidence:float;city:Optional[str]=None;country:Optional[str]=None;model_config=ConfigDict(from_attributes=True)
 class ClientModel(BaseModel):
     id:int
@@ -522,7 +596,33 @@ class HistoryModel(BaseModel):
     class Config:
         from_attributes = True
 
-class FLStatus(BaseModel): server_round: int; accuracy: float ;  loss: float
+class FLStatus(BaseModel):
+    server_round: int
+    accuracy: float
+    loss: float
+    # Participation du round (absents pour les anciens serveurs Flower)
+    participants: Optional[int] = None
+    sampled: Optional[int] = None
+    stragglers: Optional[int] = None
+    failures: Optional[int] = None
+    late_updates: Optional[int] = None
+    expired_updates: Optional[int] = None
+    mean_staleness: Optional[float] = None
+    max_staleness: Optional[int] = None
+    round_duration: Optional[float] = None
+class ModelVersion(BaseModel):
+    version: int
+    server_round: int
+    accuracy: Optional[float] = None
+    loss: Optional[float] = None
+    created_at: datetime
+    sha256: str
+
+class ModelRegistryState(BaseModel):
+    current: Optional[int] = None
+    pinned: bool = False
+    previous: Optional[int] = None
+    versions: List[ModelVersion]
 class ClientHistoryPayload(BaseModel):
     client_flower_id: str; server_round: int; accuracy: float; loss: float
 
@@ -680,43 +780,98 @@ async def get_current_admin_user(user: User = Depends(get_current_user)):
     return user
 
 
+class CachedDevice(NamedTuple):
+    id: int
+    name: str
+    owner_id: Optional[int]
+    prevention_enabled: bool
+
+
+# Les appareils appellent sans arrêt (heartbeat, settings, logs) : on garde api_key -> appareil
+# en mémoire. Invalidé explicitement quand l'appareil change ; le TTL court couvre les autres workers.
+device_cache = LRUTTLCache(DEVICE_CACHE_SIZE, DEVICE_CACHE_TTL)
+
+
+def get_cached_device(db: Session, api_key: str) -> Optional[CachedDevice]:
+    cached = device_cache.get(api_key)
+    if cached is not None:
+        return cached
+    device = db.query(Device).filter(Device.api_key == api_key).first()
+    if not device:
+        return None
+    cached = CachedDevice(device.id, device.name, device.owner_id, bool(device.prevention_enabled))
+    device_cache.set(api_key, cached)
+    return cached
+
+
+NO_GEOIP = (None, None, None, None)
+
+
+def _lookup_geoip(ip: str):
+    """Lecture brute dans la base mmdb (sans cache). Peut lever AddressNotFoundError."""
+    response = geoip_reader.city(ip)
+    country = response.country.name
+
+    # On essaie de prendre les coordonnées de la ville en premier
+    if response.location.latitude and response.location.longitude:
+        lat = response.location.latitude
+        lon = response.location.longitude
+        city = response.city.name
+    # Si la ville n'a pas de coordonnées, on prend celles du pays
+    elif response.country.location.latitude and response.country.location.longitude:
+        lat = response.country.location.latitude
+        lon = response.country.location.longitude
+        city = None # On indique explicitement qu'on n'a pas de ville
+    else:
+        # Si on n'a aucune coordonnée, on abandonne
+        return None, None, country, None
+
+    return lat, lon, city, country
+
+
 def enrich_geoip(ip: str):
-    if not geoip_reader:
-        return None, None, None, None
-    
-    if not ip or ip.startswith(("192.168", "10.", "127.")):
-        return None, None, None, None
-        
+    if not geoip_reader or not ip:
+        return NO_GEOIP
+
+    cached = geoip_cache.get(ip)
+    if cached is not None:
+        return cached
+
+    category = special_networks.classify(ip)
+    if category == "invalid":
+        # IP mal formée : pas de mise en cache, sinon n'importe quelle chaîne occupe une entrée
+        return NO_GEOIP
+    if category is not None:
+        geoip_cache.set(ip, NO_GEOIP, negative=True)
+        return NO_GEOIP
+
     try:
-        response = geoip_reader.city(ip)
-        country = response.country.name
-        
-        # === LA CORRECTION EST ICI ===
-        # On essaie de prendre les coordonnées de la ville en premier
-        if response.location.latitude and response.location.longitude:
-            lat = response.location.latitude
-            lon = response.location.longitude
-            city = response.city.name
-        # Si la ville n'a pas de coordonnées, on prend celles du pays
-        elif response.country.location.latitude and response.country.location.longitude:
-            lat = response.country.location.latitude
-            lon = response.country.location.longitude
-            city = None # On indique explicitement qu'on n'a pas de ville
-        else:
-            # Si on n'a aucune coordonnée, on abandonne
-            return None, None, country, None
-            
-        return lat, lon, city, country
-        
+        result = _lookup_geoip(ip)
     except geoip2.errors.AddressNotFoundError:
-        return None, None, None, None
+        geoip_cache.set(ip, NO_GEOIP, negative=True)
+        return NO_GEOIP
     except Exception:
-        return None, None, None, None
+        # Erreur inattendue (base illisible...) : on ne la met pas en cache
+        return NO_GEOIP
 
+    geoip_cache.set(ip, result)
+    return result
 
-async def send_ntfy_notification(attack: AttackLog):
+
+async def send_ntfy_notification(attacks: List[Dict]):
+    """Envoie UNE notification ntfy pour un lot d'attaques (un lot d'une seule attaque = message habituel)."""
+    if not attacks:
+        return
     try:
-        message = f"🚨 {attack.attack_type} from {attack.source_ip} ({attack.country or 'Unknown'})"
+        if len(attacks) == 1:
+            attack = attacks[0]
+            message = f"🚨 {attack['attack_type']} from {attack['source_ip']} ({attack['country'] or 'Unknown'})"
+        else:
+            by_type: Dict[str, int] = {}
+            for attack in attacks:
+                by_type[attack["attack_type"]] = by_type.get(attack["attack_type"], 0) + 1
+            summary = ", ".join(f"{count}x {attack_type}" for attack_type, count in sorted(by_type.items(), key=lambda kv: -kv[1]))
+            message = f"🚨 {len(attacks)} attacks detected: {summary}"
         async with httpx.AsyncClient() as client:
             await client.post(
                 os.getenv("NTFY_TOPIC_URL", "https://ntfy.sh/ok"),
@@ -741,6 +896,141 @@ def log_to_json_serializable(log_entry: AttackLog) -> Dict:
     }
 
 
+def hour_bucket(ts: datetime) -> datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def dialect_insert(db: Session, table):
+    """INSERT avec support de ON CONFLICT (PostgreSQL / SQLite), sinon None."""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return pg_dialect.insert(table)
+    if dialect == "sqlite":
+        return sqlite_dialect.insert(table)
+    return None
+
+
+# Présence réelle des index en base (create_all n'ajoute rien aux tables existantes)
+index_presence_cache = LRUTTLCache(64, 300)
+
+
+def index_exists(db: Session, table, name: str) -> bool:
+    """Vrai si l'index `name` existe en base ; résultat gardé 5 min par worker."""
+    exists = index_presence_cache.get((table.name, name))
+    if exists is None:
+        exists = any(index["name"] == name for index in sa_inspect(db.get_bind()).get_indexes(table.name))
+        index_presence_cache.set((table.name, name), exists)
+    return exists
+
+
+def missing_indexes(db: Session) -> List[Index]:
+    """Index déclarés sur attack_logs / client_history mais absents en base (créés par create_indexes.py)."""
+    return [
+        index for table in (AttackLog.__table__, ClientHistory.__table__)
+        for index in sorted(table.indexes, key=lambda index: index.name)
+        if not index_exists(db, table, index.name)
+    ]
+
+
+def dedupe_client_history(db: Session) -> int:
+    """
+    Supprime les doublons (client, server_round) enregistrés avant l'index unique
+    uq_client_history_client_round ; garde la ligne la plus récente (id max). Pas de commit.
+    """
+    keep = select(func.max(ClientHistory.id)).group_by(ClientHistory.client_id, ClientHistory.server_round)
+    return db.query(ClientHistory).filter(
+        ClientHistory.client_id.isnot(None), ClientHistory.id.not_in(keep)
+    ).delete(synchronize_session=False)
+
+
+def attack_rollup_rows(events) -> List[Dict]:
+    """`events` = itérable de (device_api_key, attack_type, timestamp) -> lignes de rollup agrégées."""
+    totals: Dict[Tuple[str, str, datetime], List] = {}
+    for device_api_key, attack_type, ts in events:
+        key = (device_api_key or "", attack_type, hour_bucket(ts))
+        total = totals.get(key)
+        if total is None:
+            totals[key] = [1, ts]
+        else:
+            total[0] += 1
+            total[1] = max(total[1], ts)
+    return [
+        {"device_api_key": k, "attack_type": t, "bucket": b, "count": count, "last_seen": last_seen}
+        for (k, t, b), (count, last_seen) in totals.items()
+    ]
+
+
+def upsert_attack_rollups(db: Session, rows: List[Dict]):
+    """Ajoute les compteurs de `rows` aux rollups existants (dans la transaction de l'appelant)."""
+    if not rows:
+        return
+    # Toujours le même ordre de verrouillage des lignes : deux lots concurrents (ingestor, /report/bulk,
+    # autres workers) qui touchent les mêmes clés ne peuvent pas s'interbloquer
+    rows = sorted(rows, key=lambda row: (row["device_api_key"], row["attack_type"] or "", row["bucket"]))
+    table = AttackRollup.__table__
+    stmt = dialect_insert(db, table)
+    if stmt is not None:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.device_api_key, table.c.attack_type, table.c.bucket],
+            set_={
+                "count": table.c.count + stmt.excluded.count,
+                "last_seen": case((table.c.last_seen >= stmt.excluded.last_seen, table.c.last_seen), else_=stmt.excluded.last_seen),
+            },
+        )
+        db.execute(stmt, rows)
+        return
+    # Autres SGBD : lecture puis mise à jour ligne par ligne
+    for row in rows:
+        rollup = db.query(AttackRollup).filter_by(
+            device_api_key=row["device_api_key"], attack_type=row["attack_type"], bucket=row["bucket"]
+        ).with_for_update().first()
+        if rollup:
+            rollup.count += row["count"]
+            rollup.last_seen = max(rollup.last_seen, row["last_seen"])
+        else:
+            db.add(AttackRollup(**row))
+
+
+def rebuild_attack_rollups(db: Session, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                           chunk_size: int = 5000) -> Tuple[int, int]:
+    """
+    Recalcule les rollups de [since, until) (bornes arrondies à l'heure) à partir de attack_logs.
+    Sans `since`, on part de l'heure du plus ancien log encore présent : les rollups plus anciens
+    sont le seul historique des logs supprimés par attack_retention.py et sont conservés.
+    Renvoie (lignes de rollup, attaques couvertes). Le commit est laissé à l'appelant.
+    """
+    if since is None:
+        since = db.query(func.min(AttackLog.timestamp)).scalar()
+        if since is None:
+            return 0, 0
+    since = hour_bucket(since)
+    query = db.query(AttackLog.device_api_key, AttackLog.attack_type, AttackLog.timestamp).filter(AttackLog.timestamp >= since)
+    deleted = db.query(AttackRollup).filter(AttackRollup.bucket >= since)
+    if until:
+        until = hour_bucket(until)
+        query = query.filter(AttackLog.timestamp < until)
+        deleted = deleted.filter(AttackRollup.bucket < until)
+    deleted.delete(synchronize_session=False)
+
+    # Agrégation en mémoire : une ligne par (appareil, type, heure), pas par attaque
+    rows = attack_rollup_rows(query.execution_options(yield_per=chunk_size))
+    for start in range(0, len(rows), chunk_size):
+        upsert_attack_rollups(db, rows[start:start + chunk_size])
+    return len(rows), sum(row["count"] for row in rows)
+
+
+def rollup_attack_stats(db: Session, since: datetime, device_keys: Optional[List[str]] = None) -> Tuple[int, Optional[datetime]]:
+    """(nombre d'attaques depuis `since` à l'heure près, dernière attaque) lus dans les rollups."""
+    scope = []
+    if device_keys is not None:
+        scope.append(AttackRollup.device_api_key.in_(device_keys))
+    count = db.query(func.coalesce(func.sum(AttackRollup.count), 0)).filter(
+        AttackRollup.bucket >= hour_bucket(since), *scope
+    ).scalar()
+    last_seen = db.query(func.max(AttackRollup.last_seen)).filter(*scope).scalar()
+    return int(count), last_seen
+
+
 # ------------------------------------------------------------
 # SECTION 7: Lifespan & app instance
 # ------------------------------------------------------------
@@ -754,6 +1044,12 @@ async def lifespan(app: FastAPI):
         client_kwargs={"scope": "openid email profile"},
     )
     Base.metadata.create_all(bind=engine)
+    # create_all ne touche pas aux tables existantes. Construire un index sur attack_logs bloquerait
+    # les écritures (et le démarrage) pendant tout le build : on signale seulement ce qui manque.
+    with SessionLocal() as db:
+        missing = missing_indexes(db)
+    if missing:
+        print(f"⚠️ Missing indexes: {', '.join(index.name for index in missing)}. Run 'python create_indexes.py'.")
     # create default admin if none
     with SessionLocal() as db:
         # On vérifie si un utilisateur avec cet email ou ce username existe déjà
@@ -777,8 +1073,16 @@ async def lifespan(app: FastAPI):
         else:
             print("Admin user 'yasmine' already exists. Skipping creation.")
     # === FIN DE LA CORRECTION ===
-            
+
+    await manager.start()
+    attack_ingestor.start()
+    presence.start()
     yield
+    await attack_ingestor.stop()
+    await presence.stop()
+    await manager.close()
+    geoip_pool.shutdown()
+    db_pool.shutdown()
 
 app = FastAPI(title="FedIds API", lifespan=lifespan)
 
@@ -794,27 +1098,706 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Link", "X-Next-Cursor", "X-Total-Count"],
 )
 
 
 # WebSocket manager
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# Que faire d'un client trop lent dont la file est pleine : "drop_oldest" ou "disconnect"
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+# Mode "batch" (opt-in, ?batch=1) : un seul frame par tick, agrégé au-delà du seuil
+WS_BATCH_INTERVAL = float(os.getenv("WS_BATCH_INTERVAL_MS", "200")) / 1000
+WS_AGGREGATE_THRESHOLD = int(os.getenv("WS_AGGREGATE_THRESHOLD", "200"))
+# "memory" (un seul worker) ou "unix" (plusieurs workers uvicorn sur la même machine)
+WS_BROKER = os.getenv("WS_BROKER", "memory")
+WS_BROKER_DIR = os.getenv("WS_BROKER_DIR", os.path.join(tempfile.gettempdir(), "fedids-ws"))
+
+
+class Subscriber:
+    """
+    Une connexion WebSocket abonnée à un canal.
+    `api_keys` = appareils de l'utilisateur dont il reçoit les attaques (None = tout, ex: admin).
+    Les messages passent par une file bornée vidée par une tâche d'écriture dédiée,
+    pour qu'un client lent ne ralentisse jamais les autres.
+    """
+
+    def __init__(self, ws: WebSocket, channel: str, user_id: Optional[int], api_keys: Optional[Set[str]], queue_size: int, batched: bool = False):
+        self.ws = ws
+        self.channel = channel
+        self.user_id = user_id
+        self.api_keys = set(api_keys) if api_keys is not None else None
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.writer: Optional[asyncio.Task] = None
+        # Mode batch : événements (déjà sérialisés) en attente du prochain tick
+        self.batched = batched
+        self.pending: List[str] = []
+        self.pending_total = 0
+        self.pending_counts: Dict[Tuple[Optional[str], Optional[str]], int] = {}
+
+
 class ConnectionManager:
+    def __init__(self, broker: Broker, queue_size: int = WS_SEND_QUEUE_SIZE, slow_consumer_policy: str = WS_SLOW_CONSUMER_POLICY):
+        # Le broker fait passer chaque broadcast par tous les workers, qui délivrent localement
+        self.broker = broker
+        self.queue_size = queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.channels: Dict[str, Set[Subscriber]] = {"attacks": set(), "fl_status": set()}
+        self.subscribers: Dict[WebSocket, Subscriber] = {}
+        # canal -> api_key -> abonnés intéressés par cet appareil
+        self.device_index: Dict[str, Dict[str, Set[Subscriber]]] = {}
+        # canal -> abonnés sans filtre (admins, fl_status)
+        self.unfiltered: Dict[str, Set[Subscriber]] = {}
+        # Les routes synchrones (threadpool) peuvent mettre à jour les filtres : on protège les index
+        self._lock = threading.Lock()
+        self._ticker: Optional[asyncio.Task] = None
+        # Fermetures de sockets en cours (référence gardée : sinon la tâche peut être collectée)
+        self._closing: Set[asyncio.Task] = set()
+        # Canaux internes (sans socket) : canal -> callbacks(device_api_key, event), appelés dans chaque worker
+        self.listeners: Dict[str, List] = {}
+
+    async def connect(self, ws: WebSocket, channel: str, user_id: Optional[int] = None, api_keys: Optional[Set[str]] = None, batched: bool = False) -> Subscriber:
+        await ws.accept()
+        sub = Subscriber(ws, channel, user_id, api_keys, self.queue_size, batched)
+        with self._lock:
+            self.channels.setdefault(channel, set()).add(sub)
+            self.subscribers[ws] = sub
+            self._index(sub)
+        sub.writer = asyncio.create_task(self._writer(sub))
+        if batched and self._ticker is None:
+            self._ticker = asyncio.create_task(self._tick())
+        return sub
+
+    async def start(self):
+        await self.broker.start(self.deliver)
+
+    def add_listener(self, channel: str, callback):
+        self.listeners.setdefault(channel, []).append(callback)
+
+    async def close(self):
+        if self._ticker:
+            self._ticker.cancel()
+            self._ticker = None
+        await self.broker.close()
+
+    def disconnect(self, ws: WebSocket, channel: Optional[str] = None):
+        with self._lock:
+            sub = self.subscribers.pop(ws, None)
+            if not sub:
+                return
+            self.channels.get(sub.channel, set()).discard(sub)
+            self._unindex(sub)
+        if sub.writer and not sub.writer.done() and sub.writer is not asyncio.current_task():
+            sub.writer.cancel()
+
+    def update_user_devices(self, user_id: int, api_keys: Set[str]):
+        """Met à jour le filtre des connexions ouvertes d'un utilisateur (appareil ajouté / supprimé)."""
+        with self._lock:
+            for sub in self.subscribers.values():
+                if sub.user_id == user_id and sub.api_keys is not None:
+                    self._unindex(sub)
+                    sub.api_keys = set(api_keys)
+                    self._index(sub)
+
+    async def broadcast(self, msg: str, ch: str, device_api_key: Optional[str] = None, event: Optional[Dict] = None):
+        """Diffuse vers les sockets de TOUS les workers (via le broker)."""
+        await self.broker.publish(ch, msg, device_api_key, event)
+
+    async def deliver(self, ch: str, msg: str, device_api_key: Optional[str] = None, event: Optional[Dict] = None):
+        """
+        Diffusion locale à ce worker, appelée par le broker.
+        Met `msg` dans la file des abonnés concernés : les abonnés sans filtre, plus ceux
+        qui suivent `device_api_key`. Le coût dépend du nombre d'intéressés, pas du total.
+        `msg` est sérialisé une seule fois ; `event` (optionnel) sert à l'agrégation du mode batch.
+        """
+        for callback in self.listeners.get(ch, ()):
+            callback(device_api_key, event)
+        with self._lock:
+            targets = list(self.unfiltered.get(ch, ()))
+            if device_api_key is not None:
+                targets.extend(self.device_index.get(ch, {}).get(device_api_key, ()))
+        for sub in targets:
+            if sub.batched:
+                self._buffer(sub, msg, event)
+            else:
+                self._enqueue(sub, msg)
+
+    def _buffer(self, sub: Subscriber, msg: str, event: Optional[Dict]):
+        sub.pending_total += 1
+        group = (event.get("attack_type"), event.get("country")) if event else (None, None)
+        sub.pending_counts[group] = sub.pending_counts.get(group, 0) + 1
+        # Au-delà du seuil, le frame sera agrégé : inutile de garder les messages
+        if sub.pending_total <= WS_AGGREGATE_THRESHOLD:
+            sub.pending.append(msg)
+
+    def _batch_frame(self, sub: Subscriber) -> str:
+        if sub.pending_total <= WS_AGGREGATE_THRESHOLD:
+            # Les événements sont déjà du JSON : on les concatène sans les re-sérialiser
+            frame = '{"type": "batch", "events": [' + ", ".join(sub.pending) + "]}"
+        else:
+            groups = sorted(sub.pending_counts.items(), key=lambda kv: -kv[1])
+            frame = json.dumps({
+                "type": "aggregate",
+                "window_ms": int(WS_BATCH_INTERVAL * 1000),
+                "total": sub.pending_total,
+                "groups": [{"attack_type": attack_type, "country": country, "count": count} for (attack_type, country), count in groups],
+            })
+        sub.pending, sub.pending_total, sub.pending_counts = [], 0, {}
+        return frame
+
+    async def _tick(self):
+        while True:
+            await asyncio.sleep(WS_BATCH_INTERVAL)
+            with self._lock:
+                ready = [sub for sub in self.subscribers.values() if sub.batched and sub.pending_total]
+            for sub in ready:
+                self._enqueue(sub, self._batch_frame(sub))
+
+    def _index(self, sub: Subscriber):
+        if sub.api_keys is None:
+            self.unfiltered.setdefault(sub.channel, set()).add(sub)
+            return
+        index = self.device_index.setdefault(sub.channel, {})
+        for api_key in sub.api_keys:
+            index.setdefault(api_key, set()).add(sub)
+
+    def _unindex(self, sub: Subscriber):
+        if sub.api_keys is None:
+            self.unfiltered.get(sub.channel, set()).discard(sub)
+            return
+        index = self.device_index.get(sub.channel, {})
+        for api_key in sub.api_keys:
+            subs = index.get(api_key)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del index[api_key]
+
+    def _enqueue(self, sub: Subscriber, msg: str):
+        try:
+            sub.queue.put_nowait(msg)
+            return
+        except asyncio.QueueFull:
+            pass
+        if self.slow_consumer_policy == "disconnect":
+            print(f"⚠️ [WebSocket] Disconnecting slow consumer on '{sub.channel}' (user {sub.user_id}).")
+            self.disconnect(sub.ws)
+            task = asyncio.create_task(self._close(sub.ws))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+        else:
+            sub.queue.get_nowait()
+            sub.dropped += 1
+            sub.queue.put_nowait(msg)
+
+    async def _writer(self, sub: Subscriber):
+        try:
+            while True:
+                msg = await sub.queue.get()
+                await sub.ws.send_text(msg)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(sub.ws)
+
+    @staticmethod
+    async def _close(ws: WebSocket):
+        try:
+            await ws.close(code=http_status.WS_1013_TRY_AGAIN_LATER)
+        except Exception:
+            pass
+
+
+manager = ConnectionManager(create_broker(WS_BROKER, WS_BROKER_DIR))
+
+
+# ------------------------------------------------------------
+# Attack ingestion pipeline (write-behind)
+# ------------------------------------------------------------
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL_MS", "200")) / 1000
+INGEST_RETRIES = int(os.getenv("INGEST_RETRIES", "3"))
+INGEST_RETRY_BACKOFF = float(os.getenv("INGEST_RETRY_BACKOFF_MS", "500")) / 1000
+# Lots qui n'ont pas pu être écrits : gardés sur disque et rejoués au prochain démarrage
+INGEST_SPILL_PATH = os.getenv("INGEST_SPILL_PATH", "attack_ingest_spill.jsonl")
+# "queued" : /api/attacks/report répond 202 avant l'écriture ; "sync" : ancien contrat,
+# le log est écrit avant la réponse (200 + AttackLogPublic) pour les clients qui lisent son id
+ATTACK_REPORT_MODE = os.getenv("ATTACK_REPORT_MODE", "queued")
+BULK_REPORT_MAX_ITEMS = int(os.getenv("BULK_REPORT_MAX_ITEMS", "5000"))
+# Taille maximale du corps d'un lot, vérifiée avant de le lire en mémoire
+BULK_REPORT_MAX_BYTES = int(os.getenv("BULK_REPORT_MAX_BYTES", str(16 * 1024 * 1024)))
+GEOIP_POOL_WORKERS = int(os.getenv("GEOIP_POOL_WORKERS", "4"))
+DB_POOL_WORKERS = int(os.getenv("DB_POOL_WORKERS", "4"))
+BLOCKING_POOL_QUEUE = int(os.getenv("BLOCKING_POOL_QUEUE", "1000"))
+
+# Pools dédiés : les handlers async n'appellent JAMAIS GeoIP ni db.commit() directement
+geoip_pool = BlockingPool("geoip", GEOIP_POOL_WORKERS, BLOCKING_POOL_QUEUE)
+db_pool = BlockingPool("db-writes", DB_POOL_WORKERS, BLOCKING_POOL_QUEUE)
+
+
+def build_attack_logs(items: List[Tuple[AttackReport, datetime]]) -> List[AttackLog]:
+    """Enrichissement GeoIP d'un lot de rapports (bloquant, exécuté dans `geoip_pool`)."""
+    logs = []
+    for report, received_at in items:
+        lat, lon, city, country = enrich_geoip(report.source_ip)
+        logs.append(AttackLog(
+            timestamp=received_at,
+            source_ip=report.source_ip,
+            attack_type=report.attack_type,
+            confidence=report.confidence,
+            device_api_key=report.api_key,
+            latitude=lat,
+            longitude=lon,
+            city=city,
+            country=country,
+        ))
+    return logs
+
+
+def insert_attack_logs(logs: List[AttackLog]) -> List[Dict]:
+    """
+    Insère un lot de logs en une seule transaction (bloquant, exécuté dans `db_pool`).
+    Renvoie les logs sérialisés (avec leur id) dans le même ordre.
+    """
+    with SessionLocal() as db:
+        # add_all + flush => un INSERT multi-lignes au lieu d'un commit par attaque
+        db.add_all(logs)
+        db.flush()
+        upsert_attack_rollups(db, attack_rollup_rows((log.device_api_key, log.attack_type, log.timestamp) for log in logs))
+        payloads = [log_to_json_serializable(log) for log in logs]
+        db.commit()
+    return payloads
+
+
+async def persist_attack_reports(items: List[Tuple[AttackReport, datetime]]) -> List[Dict]:
+    logs = await geoip_pool.run(build_attack_logs, items)
+    return await db_pool.run(insert_attack_logs, logs)
+
+
+class AttackIngestor:
+    """
+    File d'attente en mémoire pour /api/attacks/report.
+    Les rapports sont acceptés immédiatement ; un consommateur en arrière-plan les regroupe
+    (INGEST_BATCH_SIZE rapports ou INGEST_FLUSH_INTERVAL secondes) en un seul INSERT,
+    puis lance le broadcast WebSocket et la notification ntfy APRÈS le commit du lot.
+
+    Les rapports ont déjà reçu un 202 : un lot dont l'écriture échoue est réessayé
+    (`retries` fois, backoff exponentiel), puis écrit dans `spill_path` et rejoué au démarrage.
+    """
+
+    def __init__(self, max_queue: int, batch_size: int, flush_interval: float,
+                 retries: int = 3, retry_backoff: float = 0.5, spill_path: Optional[str] = None):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.spill_path = spill_path
+        self._task: Optional[asyncio.Task] = None
+        self._background: set = set()
+        self.persisted = 0
+        self.retried = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._task is None:
+            self._replay_spill()
+            self._task = asyncio.create_task(self._consume())
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self.queue.qsize(),
+            "persisted": self.persisted,
+            "retried_batches": self.retried,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "dropped": self.dropped,
+        }
+
+    async def stop(self):
+        """Vide la file, attend le dernier lot puis les broadcasts en cours."""
+        if self._task is None:
+            return
+        await self.queue.put(None)
+        await self._task
+        self._task = None
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+    def submit(self, report: AttackReport) -> bool:
+        try:
+            self.queue.put_nowait((report, datetime.utcnow()))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def spawn(self, coro):
+        # On garde une référence sur la tâche pour qu'elle ne soit pas collectée en cours de route
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def publish(self, events: List[Tuple[Optional[str], Dict]]):
+        """`events` = (device_api_key, log sérialisé) ; la clé sert au routage, jamais envoyée au navigateur."""
+        for device_api_key, payload in events:
+            await manager.broadcast(json.dumps(payload), "attacks", device_api_key, event=payload)
+        await send_ntfy_notification([payload for _, payload in events])
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            batch, stopping = [item], False
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _flush(self, batch: List[Tuple[AttackReport, datetime]]):
+        for attempt in range(self.retries + 1):
+            try:
+                payloads = await persist_attack_reports(batch)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    print(f"❌ [Ingest] Failed to persist a batch of {len(batch)} attack reports after {attempt + 1} attempts: {e}")
+                    await asyncio.to_thread(self._spill, batch)
+                    return
+                self.retried += 1
+                delay = self.retry_backoff * 2 ** attempt
+                print(f"⚠️ [Ingest] Batch of {len(batch)} attack reports failed ({e}), retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+        self.persisted += len(batch)
+        self.spawn(self.publish([(report.api_key, payload) for (report, _), payload in zip(batch, payloads)]))
+
+
+    def _spill(self, batch: List[Tuple[AttackReport, datetime]]):
+        if not self.spill_path:
+            self.dropped += len(batch)
+            return
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps({"report": report.model_dump(), "received_at": received_at.isoformat()}) + "\n"
+                             for report, received_at in batch)
+            self.spilled += len(batch)
+            print(f"💾 [Ingest] {len(batch)} attack reports spilled to {self.spill_path}, replayed at next startup.")
+        except OSError as e:
+            self.dropped += len(batch)
+            print(f"❌ [Ingest] Could not spill {len(batch)} attack reports, they are lost: {e}")
+
+    def _replay_spill(self):
+        """Remet en file les rapports du spill (renommé d'abord : un seul worker le reprend)."""
+        if not self.spill_path:
+            return
+        claimed = f"{self.spill_path}.{os.getpid()}.replay"
+        try:
+            os.replace(self.spill_path, claimed)
+        except FileNotFoundError:
+            return
+        with open(claimed, encoding="utf-8") as f:
+            lines = [line for line in f if line.strip()]
+        pending, corrupt = [], []
+        for line in lines:
+            try:
+                record = json.loads(line)
+                pending.append((AttackReport(**record["report"]), datetime.fromisoformat(record["received_at"])))
+            except (ValueError, KeyError, TypeError):
+                # Ligne tronquée par un arrêt brutal pendant l'écriture : mise de côté, pas rejouée
+                corrupt.append(line if line.endswith("\n") else line + "\n")
+        if corrupt:
+            try:
+                with open(f"{self.spill_path}.corrupt", "a", encoding="utf-8") as f:
+                    f.writelines(corrupt)
+                print(f"⚠️ [Ingest] {len(corrupt)} unreadable spill lines moved to {self.spill_path}.corrupt.")
+            except OSError as e:
+                print(f"❌ [Ingest] Skipped {len(corrupt)} unreadable spill lines: {e}")
+            self.dropped += len(corrupt)
+        for index, item in enumerate(pending):
+            try:
+                self.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self._spill(pending[index:])
+                break
+            self.replayed += 1
+        os.unlink(claimed)
+        print(f"📮 [Ingest] Replaying {self.replayed} spilled attack reports.")
+
+
+attack_ingestor = AttackIngestor(INGEST_QUEUE_SIZE, INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL,
+                                 INGEST_RETRIES, INGEST_RETRY_BACKOFF, INGEST_SPILL_PATH)
+
+
+# ------------------------------------------------------------
+# Device settings push (long-poll)
+# ------------------------------------------------------------
+DEVICE_SETTINGS_MAX_WAIT = float(os.getenv("DEVICE_SETTINGS_MAX_WAIT", "55"))
+
+
+class DeviceSettingsHub:
+    """Réveille les long-polls en attente sur un appareil quand ses réglages changent."""
+
     def __init__(self):
-        self.channels: Dict[str, List[WebSocket]] = {"attacks": [], "fl_status": []}
+        self._waiters: Dict[str, Set[asyncio.Future]] = {}
 
-    async def connect(self, ws: WebSocket, channel: str):
-        await ws.accept()
-        self.channels.setdefault(channel, []).append(ws)
+    def subscribe(self, api_key: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(api_key, set()).add(future)
+        return future
+
+    def unsubscribe(self, api_key: str, future: asyncio.Future):
+        waiters = self._waiters.get(api_key)
+        if waiters is not None:
+            waiters.discard(future)
+            if not waiters:
+                del self._waiters[api_key]
+
+    def notify(self, api_key: str):
+        for future in self._waiters.pop(api_key, ()):
+            if not future.done():
+                future.set_result(None)
+
+    def waiting(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+
+settings_hub = DeviceSettingsHub()
+
+
+def _on_device_settings_changed(api_key: Optional[str], event: Optional[Dict] = None):
+    # Appelé dans CHAQUE worker (via le broker) : on jette le cache puis on réveille les long-polls
+    if api_key:
+        device_cache.invalidate(api_key)
+        settings_hub.notify(api_key)
+
+
+manager.add_listener("device_settings", _on_device_settings_changed)
+
+
+async def publish_device_settings(api_key: str):
+    await manager.broadcast(json.dumps({"api_key": api_key}), "device_settings", api_key)
 
-    def disconnect(self, ws: WebSocket, channel: str):
-        if ws in self.channels.get(channel, []):
-            self.channels[channel].remove(ws)
 
-    async def broadcast(self, msg: str, ch: str):
-        await asyncio.gather(*(c.send_text(msg) for c in self.channels.get(ch, [])), return_exceptions=True)
+def _on_user_devices_changed(api_key: Optional[str], event: Optional[Dict] = None):
+    # Appelé dans CHAQUE worker : les dashboards de l'utilisateur peuvent être ouverts sur un autre worker
+    if event:
+        manager.update_user_devices(event["user_id"], set(event["api_keys"]))
 
 
-manager = ConnectionManager()
+manager.add_listener("user_devices", _on_user_devices_changed)
+
+
+async def publish_user_devices(user_id: int, api_keys: Set[str]):
+    event = {"user_id": user_id, "api_keys": sorted(api_keys)}
+    await manager.broadcast(json.dumps(event), "user_devices", None, event)
+
+
+def _settings_etag(settings: Dict) -> str:
+    return '"' + hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16] + '"'
+
+
+def _load_cached_device(api_key: str) -> Optional[CachedDevice]:
+    with SessionLocal() as db:
+        return get_cached_device(db, api_key)
+
+
+# ------------------------------------------------------------
+# Device presence (heartbeats)
+# ------------------------------------------------------------
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "15"))
+DEVICE_ONLINE_WINDOW = timedelta(minutes=int(os.getenv("DEVICE_ONLINE_WINDOW_MINUTES", "5")))
+
+
+class PresenceTracker:
+    """
+    Table de présence en mémoire : api_key -> last_seen.
+    Un heartbeat est une simple écriture dans un dict ; une tâche périodique persiste
+    les entrées modifiées dans `device_status` en quelques requêtes groupées.
+    Le statut online/offline est déduit de last_seen à la lecture (voir `device_status_info`).
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self.last_seen: Dict[str, datetime] = {}
+        self._dirty: Dict[str, datetime] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def touch(self, api_key: str):
+        now = datetime.utcnow()
+        with self._lock:
+            self.last_seen[api_key] = now
+            self._dirty[api_key] = now
+
+    def get(self, api_key: str) -> Optional[datetime]:
+        return self.last_seen.get(api_key)
+
+    def forget(self, api_key: str):
+        with self._lock:
+            self.last_seen.pop(api_key, None)
+            self._dirty.pop(api_key, None)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await db_pool.run(self.flush)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await db_pool.run(self.flush)
+
+    def flush(self) -> int:
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+        try:
+            with SessionLocal() as db:
+                keys = list(dirty)
+                existing = {k for (k,) in db.query(DeviceStatus.device_api_key).filter(DeviceStatus.device_api_key.in_(keys))}
+                updates = [{"key": k, "seen": ts} for k, ts in dirty.items() if k in existing]
+                if updates:
+                    # Un seul executemany ; on ne recule jamais last_seen (plusieurs workers peuvent écrire)
+                    db.execute(
+                        update(DeviceStatus.__table__)
+                        .where(DeviceStatus.__table__.c.device_api_key == bindparam("key"))
+                        .where(or_(DeviceStatus.__table__.c.last_seen.is_(None), DeviceStatus.__table__.c.last_seen < bindparam("seen")))
+                        .values(last_seen=bindparam("seen"), status="online"),
+                        updates,
+                    )
+                missing = [k for k in keys if k not in existing]
+                if missing:
+                    # L'appareil a pu être supprimé entre le heartbeat et le flush
+                    known = {k for (k,) in db.query(Device.api_key).filter(Device.api_key.in_(missing))}
+                    inserts = [{"device_api_key": k, "last_seen": dirty[k], "status": "online"} for k in missing if k in known]
+                    if inserts:
+                        db.execute(insert(DeviceStatus.__table__), inserts)
+                db.commit()
+            return len(dirty)
+        except Exception as e:
+            print(f"❌ [Presence] Failed to flush {len(dirty)} heartbeats, will retry: {e}")
+            with self._lock:
+                for k, ts in dirty.items():
+                    if k not in self._dirty or self._dirty[k] < ts:
+                        self._dirty[k] = ts
+            return 0
+
+
+presence = PresenceTracker(PRESENCE_FLUSH_INTERVAL)
+
+
+def device_status_info(api_key: str, status_obj: Optional[DeviceStatus]) -> DeviceStatusPublic:
+    """Statut d'un appareil à partir du last_seen le plus récent (mémoire de ce worker ou base)."""
+    candidates = [ts for ts in (presence.get(api_key), status_obj.last_seen if status_obj else None) if ts]
+    last_seen = max(candidates) if candidates else None
+    online = last_seen is not None and last_seen >= datetime.utcnow() - DEVICE_ONLINE_WINDOW
+    return DeviceStatusPublic(last_seen=last_seen, status="online" if online else "offline")
+
+
+LIST_MAX_LIMIT = 500
+
+
+class ListPage:
+    """
+    Pagination (skip/limit) et tri (sort/order) des listes, appliqués en SQL.
+    Sans `limit`, toute la liste est renvoyée (les pages existantes ne paginent pas).
+    """
+
+    def __init__(
+        self,
+        skip: int = Query(0, ge=0),
+        limit: Optional[int] = Query(None, ge=1, le=LIST_MAX_LIMIT),
+        sort: Optional[str] = None,
+        order: str = Query("asc", pattern="^(asc|desc)$"),
+    ):
+        self.skip = skip
+        self.limit = limit
+        self.sort = sort
+        self.order = order
+
+    def apply(self, query, columns: Dict, default: str, tiebreaker):
+        column = columns.get(self.sort or default)
+        if column is None:
+            raise HTTPException(status_code=400, detail=f"Invalid sort field. Expected one of: {', '.join(columns)}.")
+        direction = (lambda c: c.desc()) if self.order == "desc" else (lambda c: c.asc())
+        # Le départage sur l'id garde des pages stables quand la colonne triée a des doublons
+        query = query.order_by(direction(column), direction(tiebreaker)).offset(self.skip)
+        return query.limit(self.limit) if self.limit else query
+
+
+def admin_user_query(db: Session):
+    """
+    Utilisateurs + compteurs (appareils, prévention active, paiements réussis) en UNE requête :
+    les compteurs viennent de sous-requêtes groupées jointes, pas d'une requête par utilisateur.
+    """
+    device_counts = db.query(
+        Device.owner_id.label("user_id"),
+        func.count(Device.id).label("device_count"),
+        func.sum(case((Device.prevention_enabled.is_(True), 1), else_=0)).label("prevention_on"),
+    ).group_by(Device.owner_id).subquery()
+    payment_counts = db.query(
+        Payment.user_id.label("user_id"),
+        func.count(Payment.id).label("payment_count"),
+    ).filter(Payment.status == "succeeded").group_by(Payment.user_id).subquery()
+    device_count = func.coalesce(device_counts.c.device_count, 0)
+    prevention_on = func.coalesce(device_counts.c.prevention_on, 0)
+    payment_count = func.coalesce(payment_counts.c.payment_count, 0)
+    query = db.query(User, device_count, prevention_on, payment_count) \
+        .outerjoin(device_counts, device_counts.c.user_id == User.id) \
+        .outerjoin(payment_counts, payment_counts.c.user_id == User.id)
+    sort_columns = {
+        "id": User.id, "email": User.email, "username": User.username, "role": User.role,
+        "created_at": User.created_at, "device_count": device_count, "payment_count": payment_count,
+    }
+    return query, sort_columns
+
+
+def admin_user_view(row) -> UserAdminView:
+    user, device_count, prevention_on, payment_count = row
+    user_dict = UserPublic.model_validate(user).model_dump()
+    user_dict["device_count"] = device_count
+    user_dict["devices_with_prevention_on"] = prevention_on
+    user_dict["payment_count"] = payment_count
+    return UserAdminView.model_validate(user_dict)
+
+
+DEVICE_SORT_COLUMNS = {"id": Device.id, "name": Device.name, "last_seen": DeviceStatus.last_seen}
+
+
+def devices_with_status(db: Session, owner_id: int, page: ListPage) -> List[DeviceWithStatus]:
+    """Appareils d'un utilisateur avec leur statut : une jointure + un chargement groupé des catégories."""
+    query = db.query(Device, DeviceStatus) \
+        .outerjoin(DeviceStatus, DeviceStatus.device_api_key == Device.api_key) \
+        .options(selectinload(Device.category)) \
+        .filter(Device.owner_id == owner_id)
+    rows = page.apply(query, DEVICE_SORT_COLUMNS, "id", Device.id).all()
+    return [
+        DeviceWithStatus(**DevicePublic.model_validate(d).model_dump(), status_info=device_status_info(d.api_key, status_obj))
+        for d, status_obj in rows
+    ]
 
 
 # ------------------------------------------------------------
@@ -971,7 +1954,7 @@ def complete_installation(reg_token: str, db: Session = Depends(get_db)):
         db.commit()
     return {"message": "Installation completed and token invalidated."}
 @app.post("/api/devices/register", response_model=DevicePublic)
-def register_device(device_in: DeviceCreate, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def register_device(device_in: DeviceCreate, background_tasks: BackgroundTasks, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     existing_device = db.query(Device).filter(Device.name == device_in.name, Device.owner_id == user.id).first()
     if existing_device:
         raise HTTPException(status_code=400, detail=f"A device with the name '{device_in.name}' already exists.")
@@ -984,6 +1967,7 @@ def register_device(device_in: DeviceCreate, user: User = Depends(get_current_us
     db.add(new_device)
     db.commit()
     db.refresh(new_device)
+    background_tasks.add_task(publish_user_devices, user.id, {d.api_key for d in user.devices})
 
     return new_device
 
@@ -1034,44 +2018,53 @@ echo "🚀 Installation Complete!"
 """
     return script_content
 @app.get("/api/devices/my-devices-with-status", response_model=List[DeviceWithStatus])
-def get_my_devices_with_status(user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    five_min = datetime.utcnow() - timedelta(minutes=5)
-    db.query(DeviceStatus).filter(DeviceStatus.last_seen < five_min).update({"status": "offline"}, synchronize_session=False)
-    db.commit()
-    response = []
-    for d in user.devices:
-        status_obj = db.query(DeviceStatus).filter_by(device_api_key=d.api_key).first()
-        response.append(
-            DeviceWithStatus(**DevicePublic.model_validate(d).model_dump(), status_info=DeviceStatusPublic.model_validate(status_obj) if status_obj else None)
-        )
-    return response
+def get_my_devices_with_status(page: ListPage = Depends(), user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    return devices_with_status(db, user.id, page)
 
 
 @app.post("/api/devices/heartbeat")
 def device_heartbeat(payload: HeartbeatPayload, db: Session = Depends(get_db)):
-    d = db.query(Device).filter_by(api_key=payload.api_key).first()
-    if not d:
+    if not get_cached_device(db, payload.api_key):
         raise HTTPException(status_code=404, detail="Device not found")
-    status_obj = db.query(DeviceStatus).filter_by(device_api_key=d.api_key).first()
-    if status_obj:
-        status_obj.last_seen = datetime.utcnow()
-        status_obj.status = "online"
-    else:
-        db.add(DeviceStatus(device_api_key=d.api_key, status="online", last_seen=datetime.utcnow()))
-    db.commit()
+    # Pas d'écriture en base ici : `presence` persiste les heartbeats par lots
+    presence.touch(payload.api_key)
     return {"status": "ok"}
 
 
 @app.get("/api/devices/{api_key}/settings")
-def get_device_settings(api_key: str, db: Session = Depends(get_db)):
-    device = db.query(Device).filter(Device.api_key == api_key).first()
-    if not device:
-        raise HTTPException(status_code=404, detail="Device not found")
-    return {"prevention_enabled": device.prevention_enabled}
+async def get_device_settings(api_key: str, request: Request, wait: float = 0):
+    """
+    Réglages d'un appareil, avec ETag.
+    - If-None-Match à jour et wait=0 : 304 immédiat (GET conditionnel).
+    - If-None-Match à jour et wait=N : la requête reste ouverte jusqu'à N secondes (long-poll)
+      et répond dès que toggle_prevention / update_device modifient l'appareil.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(max(wait, 0.0), DEVICE_SETTINGS_MAX_WAIT)
+    while True:
+        # On s'abonne AVANT de lire, pour ne pas rater un changement entre les deux
+        changed = settings_hub.subscribe(api_key)
+        try:
+            device = await db_pool.run(_load_cached_device, api_key)
+            if not device:
+                raise HTTPException(status_code=404, detail="Device not found")
+            settings = {"prevention_enabled": device.prevention_enabled}
+            etag = _settings_etag(settings)
+            if request.headers.get("if-none-match") != etag:
+                return JSONResponse(settings, headers={"ETag": etag, "Cache-Control": "no-cache"})
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return Response(status_code=http_status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+            try:
+                await asyncio.wait_for(changed, remaining)
+            except asyncio.TimeoutError:
+                return Response(status_code=http_status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        finally:
+            settings_hub.unsubscribe(api_key, changed)
 
 
 @app.post("/api/devices/{device_id}/toggle-prevention", response_model=DevicePublic)
-def toggle_prevention(device_id: int, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def toggle_prevention(device_id: int, background_tasks: BackgroundTasks, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     if user.role != "premium":
         raise HTTPException(status_code=403, detail="This is a premium feature.")
     device = db.query(Device).filter(Device.id == device_id, Device.owner_id == user.id).first()
@@ -1080,12 +2073,15 @@ def toggle_prevention(device_id: int, user: User = Depends(get_current_user), db
     device.prevention_enabled = not device.prevention_enabled
     db.commit()
     db.refresh(device)
+    device_cache.invalidate(device.api_key)
+    background_tasks.add_task(publish_device_settings, device.api_key)
     return device
 
 
 @app.delete("/api/devices/{device_id}", status_code=http_status.HTTP_204_NO_CONTENT)
 def delete_device(
     device_id: int,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
@@ -1097,8 +2093,13 @@ def delete_device(
     if not device_to_delete:
         raise HTTPException(status_code=404, detail="Device not found.")
 
+    deleted_api_key = device_to_delete.api_key
     db.delete(device_to_delete)
     db.commit()
+    presence.forget(deleted_api_key)
+    device_cache.invalidate(deleted_api_key)
+    background_tasks.add_task(publish_device_settings, deleted_api_key)
+    background_tasks.add_task(publish_user_devices, current_user.id, {d.api_key for d in current_user.devices})
     return Response(status_code=http_status.HTTP_204_NO_CONTENT)
 
 
@@ -1119,6 +2120,7 @@ def create_category(category_data: DeviceCategoryCreate, current_user: User = De
 def update_device(
     device_id: int,
     device_data: DeviceUpdate,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -1150,6 +2152,8 @@ def update_device(
     
     db.commit()
     db.refresh(db_device)
+    device_cache.invalidate(db_device.api_key)
+    background_tasks.add_task(publish_device_settings, db_device.api_key)
     
     return db_device
 
@@ -1169,61 +2173,353 @@ def get_user_dashboard_stats(current_user: User = Depends(get_current_user), db:
     if not user_device_keys:
         return DashboardStats(device_count=0, attacks_this_week=0, last_attack_timestamp=None)
 
-    # 2. Filtrer les requêtes de statistiques par ces clés
+    # 2. Lire les compteurs pré-agrégés de ces clés (pas de scan de attack_logs)
     seven_days_ago = datetime.utcnow() - timedelta(days=7)
-    
-    attacks_count = db.query(AttackLog).filter(
-        AttackLog.device_api_key.in_(user_device_keys),
-        AttackLog.timestamp >= seven_days_ago
-    ).count()
-    
-    last_attack = db.query(AttackLog).filter(
-        AttackLog.device_api_key.in_(user_device_keys)
-    ).order_by(AttackLog.timestamp.desc()).first()
+    attacks_count, last_attack_timestamp = rollup_attack_stats(db, seven_days_ago, user_device_keys)
 
     return DashboardStats(
         device_count=len(user_device_keys),
         attacks_this_week=attacks_count,
-        last_attack_timestamp=last_attack.timestamp if last_attack else None
+        last_attack_timestamp=last_attack_timestamp
     )
+HISTORY_DEFAULT_LIMIT = 200
+HISTORY_MAX_LIMIT = 500
+
+
+def encode_history_cursor(log: AttackLog) -> str:
+    raw = json.dumps({"t": log.timestamp.isoformat(), "i": log.id}).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_history_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        return datetime.fromisoformat(data["t"]), int(data["i"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+
+class AttackHistoryFilters:
+    """Filtres et pagination communs aux historiques d'attaques (utilisateur et admin)."""
+
+    def __init__(
+        self,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        attack_type: Optional[str] = None,
+        country: Optional[str] = None,
+        device: Optional[str] = Query(None, description="Clé API de l'appareil"),
+        min_confidence: Optional[float] = Query(None, ge=0, le=1),
+        cursor: Optional[str] = None,
+        limit: int = Query(HISTORY_DEFAULT_LIMIT, ge=1, le=HISTORY_MAX_LIMIT),
+    ):
+        self.since = since
+        self.until = until
+        self.attack_type = attack_type
+        self.country = country
+        self.device = device
+        self.min_confidence = min_confidence
+        self.cursor = cursor
+        self.limit = limit
+
+    def apply(self, query):
+        """Filtres seuls, sans ordre ni curseur (réutilisable pour l'export)."""
+        if self.since:
+            query = query.filter(AttackLog.timestamp >= self.since)
+        if self.until:
+            query = query.filter(AttackLog.timestamp < self.until)
+        if self.attack_type:
+            query = query.filter(AttackLog.attack_type == self.attack_type)
+        if self.country:
+            query = query.filter(AttackLog.country == self.country)
+        if self.device:
+            query = query.filter(AttackLog.device_api_key == self.device)
+        if self.min_confidence is not None:
+            query = query.filter(AttackLog.confidence >= self.min_confidence)
+        return query
+
+    def page(self, query, request: Request, response: Response) -> List[AttackLog]:
+        """
+        Pagination keyset sur (timestamp, id) décroissants : pas d'OFFSET, coût constant
+        quelle que soit la profondeur. Le curseur de la page suivante est renvoyé dans
+        `X-Next-Cursor` et dans un en-tête `Link: <...>; rel="next"`.
+        """
+        query = self.apply(query)
+        if self.cursor:
+            ts, log_id = decode_history_cursor(self.cursor)
+            query = query.filter(or_(
+                AttackLog.timestamp < ts,
+                and_(AttackLog.timestamp == ts, AttackLog.id < log_id),
+            ))
+        rows = query.order_by(AttackLog.timestamp.desc(), AttackLog.id.desc()).limit(self.limit + 1).all()
+        if len(rows) > self.limit:
+            rows = rows[:self.limit]
+            next_cursor = encode_history_cursor(rows[-1])
+            response.headers["X-Next-Cursor"] = next_cursor
+            response.headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+        return rows
+
+
 @app.get("/api/attacks/history", response_model=List[AttackLogPublic])
 def get_attack_history(
+    request: Request,
+    response: Response,
+    filters: AttackHistoryFilters = Depends(),
     current_user: User = Depends(get_current_user), 
     db: Session = Depends(get_db)
 ):
     """
-    Renvoie l'historique des attaques DÉTECTÉES PAR LES APPAREILS DE L'UTILISATEUR.
+    Renvoie l'historique des attaques DÉTECTÉES PAR LES APPAREILS DE L'UTILISATEUR,
+    filtrable et paginé par curseur (voir `AttackHistoryFilters`).
     """
     # 1. Obtenir la liste des clés API de l'utilisateur
     user_device_keys = [d.api_key for d in current_user.devices]
     
     if not user_device_keys:
         return [] # Si l'utilisateur n'a pas d'appareils, il n'a pas d'historique
+    if filters.device and filters.device not in user_device_keys:
+        raise HTTPException(status_code=404, detail="Device not found.")
 
     # 2. Filtrer les logs d'attaques par ces clés
-    return db.query(AttackLog).filter(
-        AttackLog.device_api_key.in_(user_device_keys)
-    ).order_by(AttackLog.timestamp.desc()).limit(50).all()
-
-@app.post("/api/attacks/report", response_model=AttackLogPublic)
-async def report_attack(report: AttackReport, db: Session = Depends(get_db)):
-    lat, lon, city, country = enrich_geoip(report.source_ip)
-    new_log = AttackLog(
-        source_ip=report.source_ip,
-        attack_type=report.attack_type,
-        confidence=report.confidence,
-        device_api_key=report.api_key,
-        latitude=lat,
-        longitude=lon,
-        city=city,
-        country=country,
+    query = db.query(AttackLog).filter(AttackLog.device_api_key.in_(user_device_keys))
+    return filters.page(query, request, response)
+
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+EXPORT_COLUMNS = [
+    AttackLog.id, AttackLog.timestamp, AttackLog.source_ip, AttackLog.attack_type, AttackLog.confidence,
+    AttackLog.device_api_key, AttackLog.latitude, AttackLog.longitude, AttackLog.city, AttackLog.country,
+]
+EXPORT_FIELDS = [column.key for column in EXPORT_COLUMNS]
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def iter_attack_export_chunks(filters: AttackHistoryFilters, device_keys: Optional[List[str]]):
+    """
+    Lit les logs filtrés par paquets de EXPORT_CHUNK_SIZE via un curseur côté serveur
+    (stream_results) : la mémoire reste constante quel que soit le nombre de lignes.
+    Ouvre sa propre session, la réponse étant streamée après la fin du handler.
+    """
+    with SessionLocal() as db:
+        query = filters.apply(db.query(*EXPORT_COLUMNS))
+        if device_keys is not None:
+            query = query.filter(AttackLog.device_api_key.in_(device_keys))
+        statement = query.order_by(AttackLog.timestamp, AttackLog.id).statement
+        result = db.execute(statement.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+        for rows in result.partitions():
+            yield rows
+
+
+def _export_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _export_ndjson(chunks):
+    for rows in chunks:
+        lines = (json.dumps(dict(zip(EXPORT_FIELDS, row)), default=lambda v: v.isoformat()) for row in rows)
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class _ParquetSink(io.RawIOBase):
+    """Fichier en écriture seule vidé après chaque row group (la position reste absolue pour le footer)."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _export_parquet(chunks):
+    schema = pa.schema([
+        ("id", pa.int64()), ("timestamp", pa.timestamp("us")), ("source_ip", pa.string()),
+        ("attack_type", pa.string()), ("confidence", pa.float64()), ("device_api_key", pa.string()),
+        ("latitude", pa.float64()), ("longitude", pa.float64()), ("city", pa.string()), ("country", pa.string()),
+    ])
+    sink = _ParquetSink()
+    writer = pq.ParquetWriter(sink, schema)
+    # Un row group par paquet lu en base
+    for rows in chunks:
+        columns = list(zip(*rows))
+        writer.write_table(pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def attack_export_response(export_format: str, filters: AttackHistoryFilters, device_keys: Optional[List[str]]) -> StreamingResponse:
+    if export_format == "parquet" and pq is None:
+        raise HTTPException(status_code=501, detail="Parquet export requires pyarrow to be installed.")
+    writers = {"csv": _export_csv, "ndjson": _export_ndjson, "parquet": _export_parquet}
+    body = writers[export_format](iter_attack_export_chunks(filters, device_keys))
+    filename = f"attacks-{datetime.utcnow():%Y%m%d-%H%M%S}.{export_format}"
+    return StreamingResponse(
+        body,
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
-    db.add(new_log)
-    db.commit()
-    db.refresh(new_log)
-    await manager.broadcast(json.dumps(log_to_json_serializable(new_log)), "attacks")
-    await send_ntfy_notification(new_log)
-    return new_log
+
+
+@app.get("/api/attacks/export")
+def export_attack_history(
+    format: str = Query("csv", pattern="^(csv|ndjson|parquet)$"),
+    filters: AttackHistoryFilters = Depends(),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Exporte tout l'historique des appareils de l'utilisateur correspondant aux filtres
+    (mêmes filtres que /api/attacks/history ; `cursor` et `limit` sont ignorés).
+    """
+    user_device_keys = [d.api_key for d in current_user.devices]
+    if filters.device and filters.device not in user_device_keys:
+        raise HTTPException(status_code=404, detail="Device not found.")
+    return attack_export_response(format, filters, user_device_keys)
+
+@app.post("/api/attacks/report", status_code=http_status.HTTP_202_ACCEPTED)
+async def report_attack(report: AttackReport):
+    """
+    Accepte le rapport immédiatement ; l'insertion, le broadcast et la notification
+    sont faits par lots par `attack_ingestor`. Avec ATTACK_REPORT_MODE=sync, le log est
+    écrit avant de répondre et renvoyé comme avant (200, AttackLogPublic).
+    """
+    if ATTACK_REPORT_MODE == "sync":
+        try:
+            payloads = await persist_attack_reports([(report, datetime.utcnow())])
+        except Exception as e:
+            print(f"❌ [Ingest] Attack report failed: {e}")
+            raise HTTPException(status_code=500, detail="Database error occurred.")
+        attack_ingestor.spawn(attack_ingestor.publish([(report.api_key, payloads[0])]))
+        return JSONResponse(AttackLogPublic.model_validate(payloads[0]).model_dump(mode="json"))
+    if not attack_ingestor.submit(report):
+        raise HTTPException(status_code=503, detail="Attack ingestion queue is full. Please retry later.")
+    return {"status": "queued"}
+
+def _validation_error_message(e: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(p) for p in err['loc']) or 'body'}: {err['msg']}" for err in e.errors())
+
+
+def _bulk_report_too_large() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"A bulk report cannot be larger than {BULK_REPORT_MAX_BYTES} bytes.")
+
+
+async def _stream_bulk_report_body(request: Request):
+    """Lit le corps par morceaux et s'arrête (413) dès que BULK_REPORT_MAX_BYTES est dépassé."""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > BULK_REPORT_MAX_BYTES:
+        raise _bulk_report_too_large()
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > BULK_REPORT_MAX_BYTES:
+            raise _bulk_report_too_large()
+        yield chunk
+
+
+async def _iter_bulk_report_items(request: Request):
+    """
+    Renvoie les objets JSON du corps de la requête : soit un tableau JSON,
+    soit du NDJSON (un rapport par ligne) lu au fil de l'eau.
+    Une ligne NDJSON illisible est renvoyée comme une ValueError (statut "invalid").
+    """
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" not in content_type and "jsonlines" not in content_type:
+        body = b"".join([chunk async for chunk in _stream_bulk_report_body(request)])
+        try:
+            items = json.loads(body)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON.")
+        del body
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Body must be a JSON array of attack reports.")
+        if len(items) > BULK_REPORT_MAX_ITEMS:
+            raise HTTPException(status_code=413, detail=f"A bulk report cannot contain more than {BULK_REPORT_MAX_ITEMS} items.")
+        for item in items:
+            yield item
+        return
+
+    buffer = b""
+    async for chunk in _stream_bulk_report_body(request):
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield ValueError(f"Invalid JSON line: {e}")
+    if buffer.strip():
+        try:
+            yield json.loads(buffer)
+        except ValueError as e:
+            yield ValueError(f"Invalid JSON line: {e}")
+
+
+@app.post("/api/attacks/report/bulk", response_model=BulkReportResult)
+async def report_attacks_bulk(request: Request):
+    """
+    Reçoit un lot de rapports (tableau JSON ou NDJSON) envoyé par une passerelle.
+    Les rapports valides sont enrichis et insérés en UNE transaction ; la réponse
+    donne le statut de chaque élément dans l'ordre d'envoi.
+    """
+    statuses: List[BulkReportItemStatus] = []
+    valid: List[Tuple[int, AttackReport]] = []
+    received_at = datetime.utcnow()
+
+    index = 0
+    async for item in _iter_bulk_report_items(request):
+        if index >= BULK_REPORT_MAX_ITEMS:
+            raise HTTPException(status_code=413, detail=f"A bulk report cannot contain more than {BULK_REPORT_MAX_ITEMS} items.")
+        if isinstance(item, ValueError):
+            statuses.append(BulkReportItemStatus(index=index, status="invalid", error=str(item)))
+        else:
+            try:
+                report = AttackReport.model_validate(item)
+                valid.append((index, report))
+                statuses.append(BulkReportItemStatus(index=index, status="accepted"))
+            except ValidationError as e:
+                statuses.append(BulkReportItemStatus(index=index, status="invalid", error=_validation_error_message(e)))
+        index += 1
+
+    if valid:
+        try:
+            payloads = await persist_attack_reports([(report, received_at) for _, report in valid])
+        except Exception as e:
+            print(f"❌ [Ingest] Bulk report of {len(valid)} items failed: {e}")
+            raise HTTPException(status_code=500, detail="Database error occurred.")
+        for (item_index, _), payload in zip(valid, payloads):
+            statuses[item_index].id = payload["id"]
+        attack_ingestor.spawn(attack_ingestor.publish([(report.api_key, payload) for (_, report), payload in zip(valid, payloads)]))
+
+    return BulkReportResult(accepted=len(valid), rejected=len(statuses) - len(valid), items=statuses)
+
 
 # Dans main.py
 
@@ -1240,9 +2536,8 @@ async def fl_update(status: FLStatus):
 @app.get("/api/admin/dashboard", response_model=DashboardStats)
 def get_dashboard(current_user: User = Depends(get_current_admin_user), db: Session = Depends(get_db)):
     count = db.query(Device).count()
-    attacks = db.query(AttackLog).filter(AttackLog.timestamp > datetime.utcnow() - timedelta(days=7)).count()
-    last = db.query(AttackLog).order_by(AttackLog.timestamp.desc()).first()
-    return DashboardStats(device_count=count, attacks_this_week=attacks, last_attack_timestamp=last.timestamp if last else None)
+    attacks, last_attack_timestamp = rollup_attack_stats(db, datetime.utcnow() - timedelta(days=7))
+    return DashboardStats(device_count=count, attacks_this_week=attacks, last_attack_timestamp=last_attack_timestamp)
 
 # Dans backend/main.py
 
@@ -1301,8 +2596,21 @@ def get_client_history(client_id: int, db: Session = Depends(get_db)):
 
 
 @app.get("/api/admin/attacks/history", response_model=List[AttackLogPublic], dependencies=[Depends(get_current_admin_user)])
-def get_global_attack_history(db: Session = Depends(get_db)):
-    return db.query(AttackLog).order_by(AttackLog.timestamp.desc()).limit(200).all()
+def get_global_attack_history(
+    request: Request,
+    response: Response,
+    filters: AttackHistoryFilters = Depends(),
+    db: Session = Depends(get_db)
+):
+    return filters.page(db.query(AttackLog), request, response)
+
+
+@app.get("/api/admin/attacks/export", dependencies=[Depends(get_current_admin_user)])
+def export_global_attack_history(
+    format: str = Query("csv", pattern="^(csv|ndjson|parquet)$"),
+    filters: AttackHistoryFilters = Depends(),
+):
+    return attack_export_response(format, filters, None)
 
 
 @app.post("/api/admin/client_history")
@@ -1310,20 +2618,47 @@ def save_client_history(
     history_payload: List[ClientHistoryPayload],
     db: Session = Depends(get_db),
 ):
-    for record in history_payload:
-        client = db.query(Client).filter(Client.flower_id == record.client_flower_id).first()
-        if not client:
-            client = Client(flower_id=record.client_flower_id, name=f"Client_{record.client_flower_id[:6]}")
-            db.add(client)
-            db.commit()
-            db.refresh(client)
-        history_entry = ClientHistory(
-            client_id=client.id,
-            server_round=record.server_round,
-            accuracy=record.accuracy,
-            loss=record.loss,
-        )
-        db.add(history_entry)
+    """
+    Enregistre l'historique d'un round en une transaction : une requête pour résoudre les
+    flower_id, un INSERT groupé pour les nouveaux clients, un autre pour l'historique.
+    Idempotent sur (client, server_round) : un renvoi de server.py ne crée pas de doublon.
+    Tant que l'index unique n'existe pas en base, ON CONFLICT est impossible : on filtre
+    alors les couples déjà enregistrés.
+    """
+    if not history_payload:
+        return {"status": "history saved"}
+    flower_ids = {record.client_flower_id for record in history_payload}
+    client_ids = dict(db.query(Client.flower_id, Client.id).filter(Client.flower_id.in_(flower_ids)).all())
+
+    missing = sorted(flower_ids - client_ids.keys())
+    if missing:
+        rows = [{"flower_id": flower_id, "name": f"Client_{flower_id[:6]}"} for flower_id in missing]
+        stmt = dialect_insert(db, Client.__table__)
+        # DO NOTHING : un autre worker a pu créer le même client entre-temps
+        db.execute(stmt.on_conflict_do_nothing(index_elements=["flower_id"]) if stmt is not None else insert(Client), rows)
+        client_ids.update(db.query(Client.flower_id, Client.id).filter(Client.flower_id.in_(missing)).all())
+
+    # Un seul enregistrement par (client, round), le dernier du payload l'emporte
+    history = {
+        (client_ids[record.client_flower_id], record.server_round): {
+            "client_id": client_ids[record.client_flower_id],
+            "server_round": record.server_round,
+            "accuracy": record.accuracy,
+            "loss": record.loss,
+        }
+        for record in history_payload
+    }
+    stmt = dialect_insert(db, ClientHistory.__table__)
+    if stmt is not None and index_exists(db, ClientHistory.__table__, "uq_client_history_client_round"):
+        db.execute(stmt.on_conflict_do_nothing(index_elements=["client_id", "server_round"]), list(history.values()))
+    else:
+        existing = set(db.query(ClientHistory.client_id, ClientHistory.server_round).filter(
+            ClientHistory.client_id.in_({client_id for client_id, _ in history}),
+            ClientHistory.server_round.in_({server_round for _, server_round in history}),
+        ).all())
+        rows = [row for key, row in history.items() if key not in existing]
+        if rows:
+            db.execute(insert(ClientHistory), rows)
     db.commit()
     return {"status": "history saved"}
 
@@ -1335,26 +2670,30 @@ def get_admin_stats(db: Session = Depends(get_db)):
         total_users=db.query(User).count(),
         premium_users=db.query(User).filter(User.role == "premium").count(),
         total_devices=db.query(Device).count(),
-        online_devices=db.query(DeviceStatus).filter(DeviceStatus.status == "online").count(),
-        total_attacks_24h=db.query(AttackLog).filter(AttackLog.timestamp >= twenty_four_hours_ago).count(),
+        online_devices=db.query(DeviceStatus).filter(DeviceStatus.last_seen >= datetime.utcnow() - DEVICE_ONLINE_WINDOW).count(),
+        total_attacks_24h=rollup_attack_stats(db, twenty_four_hours_ago)[0],
     )
     return stats
 
 
+@app.get("/api/admin/cache/stats", dependencies=[Depends(get_current_admin_user)])
+def get_cache_stats():
+    """Compteurs des caches en mémoire de ce worker (pour dimensionner les caches)."""
+    return {"geoip": geoip_cache.stats(), "devices": device_cache.stats()}
+
+
+@app.get("/api/admin/executors/stats", dependencies=[Depends(get_current_admin_user)])
+def get_executor_stats():
+    """Files d'attente internes de ce worker : pools de threads bloquants et broker WebSocket."""
+    return {"geoip": geoip_pool.stats(), "db_writes": db_pool.stats(), "ws_broker": manager.broker.stats(),
+            "ingest": attack_ingestor.stats()}
+
+
 @app.get("/api/admin/users", response_model=List[UserAdminView], dependencies=[Depends(get_current_admin_user)])
-def get_all_users_for_admin(db: Session = Depends(get_db)):
-    users = db.query(User).options(selectinload(User.devices)).all()
-    response = []
-    for user in users:
-        prevention_on_count = sum(1 for device in user.devices if device.prevention_enabled)
-        payment_count = db.query(Payment).filter(Payment.user_id == user.id, Payment.status == "succeeded").count()
-        user_dict = UserPublic.model_validate(user).model_dump()
-        user_dict["device_count"] = len(user.devices)
-        user_dict["devices_with_prevention_on"] = prevention_on_count
-        user_dict["payment_count"] = payment_count
-        user_data = UserAdminView.model_validate(user_dict)
-        response.append(user_data)
-    return response
+def get_all_users_for_admin(response: Response, page: ListPage = Depends(), db: Session = Depends(get_db)):
+    query, sort_columns = admin_user_query(db)
+    response.headers["X-Total-Count"] = str(db.query(func.count(User.id)).scalar())
+    return [admin_user_view(row) for row in page.apply(query, sort_columns, "id", User.id).all()]
 @app.put("/api/admin/users/{user_id}/status", response_model=UserPublic, dependencies=[Depends(get_current_admin_user)])
 def toggle_user_status(user_id: int, db: Session = Depends(get_db)):
     """
@@ -1428,18 +2767,96 @@ def get_analysis_result(history_id: int, db: Session = Depends(get_db)):
         "report": json.loads(analysis.classification_report), # On reconvertit la chaîne JSON en dict
         "confusion_matrix_b64": analysis.confusion_matrix_b64
     }
+class ModelHolder:
+    """
+    Modèle global gardé en mémoire par ce worker. Il n'est rechargé que lorsque le
+    pointeur CURRENT du registre change (nouveau round, pin, rollback).
+    """
+
+    def __init__(self, registry: ModelRegistry):
+        self.registry = registry
+        self._lock = threading.Lock()
+        self._model = None
+        self._version: Optional[int] = None
+
+    def get(self):
+        version = self.registry.current()
+        with self._lock:
+            if self._model is None or version != self._version:
+                self._model = self.load(version)
+                self._version = version
+                print(f"🔄 Global model switched to version {version}")
+            return self._model
+
+    def load(self, version: Optional[int]):
+        model = create_model()
+        if version is None:
+            # Registre encore vide : ancien fichier de poids partagé
+            model.load_weights("global_model.weights.h5")
+        else:
+            model.set_weights(self.registry.load_weights(version))
+        return model
+
+
+model_registry = ModelRegistry()
+model_holder = ModelHolder(model_registry)
+
+
+def model_registry_state() -> ModelRegistryState:
+    pointer = model_registry.pointer()
+    return ModelRegistryState(
+        current=pointer["version"],
+        pinned=pointer["pinned"],
+        previous=pointer["previous"],
+        versions=model_registry.list_versions(),
+    )
+
+
+@app.get("/api/admin/models", response_model=ModelRegistryState, dependencies=[Depends(get_current_admin_user)])
+def list_model_versions():
+    return model_registry_state()
+
+
+@app.post("/api/admin/models/{version}/pin", response_model=ModelRegistryState, dependencies=[Depends(get_current_admin_user)])
+def pin_model_version(version: int):
+    """Sert cette version (API et prochains rounds ignorés) jusqu'à /unpin."""
+    try:
+        model_registry.pin(version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Model version not found")
+    return model_registry_state()
+
+
+@app.post("/api/admin/models/unpin", response_model=ModelRegistryState, dependencies=[Depends(get_current_admin_user)])
+def unpin_model_version():
+    model_registry.unpin()
+    return model_registry_state()
+
+
+@app.post("/api/admin/models/rollback", response_model=ModelRegistryState, dependencies=[Depends(get_current_admin_user)])
+def rollback_model_version():
+    try:
+        model_registry.rollback()
+    except KeyError:
+        raise HTTPException(status_code=409, detail="No previous model version to roll back to.")
+    return model_registry_state()
+
+
 @app.post("/api/admin/evaluate-model", response_model=EvaluationResult, dependencies=[Depends(get_current_admin_user)])
 async def evaluate_model(
     # === LA CORRECTION EST ICI ===
     # On ajoute current_user comme paramètre pour pouvoir l'utiliser
     current_user: User = Depends(get_current_admin_user), 
     file: UploadFile = File(...), 
+    version: Optional[int] = None,
     db: Session = Depends(get_db)
 ):
     
     try:
-        model = create_model()
-        model.load_weights("global_model.weights.h5")
+        # Sans `version` : modèle courant déjà en mémoire ; sinon une version précise du registre
+        model = model_holder.get() if version is None else model_holder.load(version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Model version not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Could not load model: {e}")
 
@@ -1528,37 +2945,20 @@ async def evaluate_model(
 
 @app.get("/api/admin/users/{user_id}", response_model=UserAdminView, dependencies=[Depends(get_current_admin_user)])
 def get_user_details_for_admin(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).options(selectinload(User.devices)).first()
-    if not user:
+    # On réutilise la même requête agrégée que pour la liste
+    query, _ = admin_user_query(db)
+    row = query.filter(User.id == user_id).first()
+    if not row:
         raise HTTPException(status_code=404, detail="User not found")
-        
-    # On réutilise la même logique d'enrichissement que pour la liste
-    prevention_on_count = sum(1 for device in user.devices if device.prevention_enabled)
-    payment_count = db.query(Payment).filter(Payment.user_id == user.id, Payment.status == 'succeeded').count()
-    
-    user_dict = UserPublic.model_validate(user).model_dump()
-    user_dict['device_count'] = len(user.devices)
-    user_dict['devices_with_prevention_on'] = prevention_on_count
-    user_dict['payment_count'] = payment_count
-    
-    return UserAdminView.model_validate(user_dict)
+    return admin_user_view(row)
 @app.get("/api/admin/users/{user_id}/devices", response_model=List[DeviceWithStatus], dependencies=[Depends(get_current_admin_user)])
-def get_user_devices_for_admin(user_id: int, db: Session = Depends(get_db)):
+def get_user_devices_for_admin(user_id: int, page: ListPage = Depends(), db: Session = Depends(get_db)):
     """
-    Récupère la liste de tous les appareils appartenant à un utilisateur spécifique.
+    Récupère la liste des appareils appartenant à un utilisateur spécifique (paginée).
     """
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
+    if not db.query(User.id).filter(User.id == user_id).first():
         raise HTTPException(status_code=404, detail="User not found")
-
- 
-    response = []
-    for d in user.devices:
-        status_obj = db.query(DeviceStatus).filter_by(device_api_key=d.api_key).first()
-        device_data = DeviceWithStatus.model_validate(d, context={'status_info': status_obj})
-        response.append(device_data)
-        
-    return response
+    return devices_with_status(db, user_id, page)
 
 
 FLOWER_PROCESS = None
@@ -1661,18 +3061,19 @@ async def register(user_in: UserCreate, background_tasks: BackgroundTasks, db: S
 
 @app.get("/api/admin/attacks/stats-by-type", response_model=List[AttackTypeStat], dependencies=[Depends(get_current_admin_user)])
 def get_attack_stats_by_type(db: Session = Depends(get_db)):
+    total = func.sum(AttackRollup.count)
     stats = db.query(
-        AttackLog.attack_type,
-        func.count(AttackLog.id).label("count")
-    ).group_by(AttackLog.attack_type).order_by(func.count(AttackLog.id).desc()).all()
-    return stats
+        AttackRollup.attack_type,
+        total.label("count")
+    ).group_by(AttackRollup.attack_type).order_by(total.desc()).all()
+    return [{"attack_type": attack_type, "count": int(count)} for attack_type, count in stats]
 # Flower registration
 # Dans main.py
 
 @app.post("/api/fl/register")
 def fl_register(payload: FLClientRegistration, db: Session = Depends(get_db)):
-    device = db.query(Device).filter_by(api_key=payload.api_key).first()
-    if not device or not device.owner:
+    device = get_cached_device(db, payload.api_key)
+    if not device or device.owner_id is None:
         raise HTTPException(status_code=404, detail="Device or owner not found for the given API key.")
 
     client = db.query(Client).filter_by(flower_id=payload.flower_cid).first()
@@ -1680,11 +3081,11 @@ def fl_register(payload: FLClientRegistration, db: Session = Depends(get_db)):
         client = Client(
             flower_id=payload.flower_cid,
             name=device.name,
-            owner_id=device.owner.id
+            owner_id=device.owner_id
         )
         db.add(client)
     else:
-        client.owner_id = device.owner.id
+        client.owner_id = device.owner_id
         client.name = device.name
     
     db.commit()
@@ -1719,7 +3120,11 @@ async def websocket_attacks(websocket: WebSocket, db: Session = Depends(get_db))
     user = await get_user_from_ws_token(websocket, db)
     if not user:
         return
-    await manager.connect(websocket, "attacks")
+    # Un utilisateur ne reçoit que les attaques de ses appareils ; un admin les reçoit toutes.
+    api_keys = None if user.role == "admin" else {d.api_key for d in user.devices}
+    # ?batch=1 : un frame {"type": "batch"|"aggregate"} par tick au lieu d'un message par attaque
+    batched = websocket.query_params.get("batch") in ("1", "true")
+    await manager.connect(websocket, "attacks", user_id=user.id, api_keys=api_keys, batched=batched)
     try:
         while True:
             await websocket.receive_text()
@@ -1739,7 +3144,7 @@ async def websocket_fl_status(websocket: WebSocket, db: Session = Depends(get_db
         while True:
             await websocket.receive_text() # Garde la connexion ouverte
     except WebSocketDisconnect:
-        manager.disconnect(websocket, "fl_s tatus")
+        manager.disconnect(websocket, "fl_status")
 
 
 # Google OAuth
@@ -2201,7 +3606,7 @@ async def get_chatbot_stats(db: Session = Depends(get_db)):
 @app.post("/api/devices/log-prevention", status_code=201)
 def log_prevention_action(log_data: PreventionLogCreate, db: Session = Depends(get_db)):
     # On vérifie que l'api_key est valide
-    device = db.query(Device).filter_by(api_key=log_data.api_key).first()
+    device = get_cached_device(db, log_data.api_key)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found.")
     
@@ -2219,22 +3624,7 @@ def get_prevention_logs(device_id: int, current_user: User = Depends(get_current
     if not device:
         raise HTTPException(status_code=404, detail="Device not found.")
         
-    return db.query(PreventionLog).filter(PreventionLog.api_key == device.api_key).order_by(PreventionLog.timestamp.desc()).limit(5).all()# ------------------------------------------------------------
-# WebSockets routes
-# ------------------------------------------------------------
-@app.websocket("/ws/attacks")
-async def websocket_attacks(websocket: WebSocket, db: Session = Depends(get_db)):
-    token = websocket.query_params.get("token")
-    if not token:
-        await websocket.close(code=http_status.WS_1008_POLICY_VIOLATION)
-        return
-    user = await get_current_user(token, db)
-    await manager.connect(websocket, "attacks")
-    try:
-        while True:
-            await websocket.receive_text()
-    except WebSocketDisconnect:
-        manager.disconnect(websocket, "attacks")
+    return db.query(PreventionLog).filter(PreventionLog.api_key == device.api_key).order_by(PreventionLog.timestamp.desc()).limit(5).all()
 
 # ------------------------------------------------------------
 # SECTION 10: Uvicorn launcher
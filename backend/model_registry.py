@@ -0,0 +1,175 @@
+# backend/model_registry.py
+
+import fcntl
+import glob
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from checkpoint import atomic_write
+
+MODEL_REGISTRY_DIR = os.getenv("MODEL_REGISTRY_DIR", "model_registry")
+
+
+class ModelRegistry:
+    """
+    Versions immuables des poids globaux, une par round agrégé :
+        <dir>/versions/v00012/weights.npz + meta.json (round, accuracy, loss, created_at, sha256)
+        <dir>/CURRENT.json  -> {"version": 12, "pinned": false, "previous": 11}
+
+    Les nouvelles versions deviennent "current" sauf si une version est épinglée (pin / rollback).
+    Partagé entre server.py (écrit les versions) et les workers de l'API (pin, rollback, lecture) :
+    les modifications de CURRENT.json sont sérialisées par un verrou fichier.
+    """
+
+    def __init__(self, directory: str = MODEL_REGISTRY_DIR):
+        self.directory = directory
+        self.versions_dir = os.path.join(directory, "versions")
+        self.current_path = os.path.join(directory, "CURRENT.json")
+
+    # --- Lecture ---
+
+    def version_dir(self, version: int) -> str:
+        return os.path.join(self.versions_dir, f"v{version:05d}")
+
+    def list_versions(self) -> List[Dict]:
+        versions = []
+        for path in sorted(glob.glob(os.path.join(self.versions_dir, "v*", "meta.json"))):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    versions.append(json.load(f))
+            except FileNotFoundError:
+                continue  # version supprimée par un prune concurrent
+        return versions
+
+    def get(self, version: int) -> Dict:
+        try:
+            with open(os.path.join(self.version_dir(version), "meta.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise KeyError(version)
+
+    def pointer(self) -> Dict:
+        try:
+            with open(self.current_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"version": None, "pinned": False, "previous": None}
+
+    def current(self) -> Optional[int]:
+        return self.pointer()["version"]
+
+    def load_weights(self, version: int) -> List[np.ndarray]:
+        meta = self.get(version)
+        with open(os.path.join(self.version_dir(version), "weights.npz"), "rb") as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != meta["sha256"]:
+            raise ValueError(f"Model version {version} is corrupted (sha256 mismatch).")
+        with np.load(io.BytesIO(data)) as arrays:
+            return [arrays[f"arr_{i}"] for i in range(len(arrays.files))]
+
+    # --- Écriture ---
+
+    @contextmanager
+    def _locked(self):
+        # Répertoires créés à la première écriture : importer main (tests, scripts) ne crée rien
+        os.makedirs(self.versions_dir, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write_pointer(self, pointer: Dict):
+        atomic_write(self.current_path, lambda f: f.write(json.dumps(pointer).encode("utf-8")))
+
+    def register(self, server_round: int, ndarrays: List[np.ndarray], accuracy: Optional[float] = None,
+                 loss: Optional[float] = None) -> Dict:
+        """Ajoute une version (répertoire écrit à part puis renommé : jamais visible à moitié)."""
+        buffer = io.BytesIO()
+        np.savez(buffer, *ndarrays)
+        data = buffer.getvalue()
+        with self._locked():
+            existing = [int(os.path.basename(p)[1:]) for p in glob.glob(os.path.join(self.versions_dir, "v*"))]
+            version = max(existing, default=0) + 1
+            meta = {
+                "version": version,
+                "server_round": server_round,
+                "accuracy": accuracy,
+                "loss": loss,
+                "created_at": datetime.utcnow().isoformat(),
+                "sha256": hashlib.sha256(data).hexdigest(),
+            }
+            staging = tempfile.mkdtemp(dir=self.versions_dir, prefix=".staging-")
+            try:
+                atomic_write(os.path.join(staging, "weights.npz"), lambda f: f.write(data))
+                atomic_write(os.path.join(staging, "meta.json"), lambda f: f.write(json.dumps(meta).encode("utf-8")))
+                os.rename(staging, self.version_dir(version))
+            except BaseException:
+                shutil.rmtree(staging, ignore_errors=True)
+                raise
+            pointer = self.pointer()
+            if not pointer["pinned"]:
+                self._write_pointer({"version": version, "pinned": False, "previous": pointer["version"]})
+        return meta
+
+    def update_metadata(self, version: int, **fields) -> Dict:
+        """Complète les métriques d'une version (les poids, eux, ne changent jamais)."""
+        with self._locked():
+            meta = self.get(version)
+            meta.update({k: v for k, v in fields.items() if k in ("accuracy", "loss")})
+            atomic_write(os.path.join(self.version_dir(version), "meta.json"),
+                         lambda f: f.write(json.dumps(meta).encode("utf-8")))
+        return meta
+
+    def pin(self, version: int) -> Dict:
+        """Sert `version` et ignore les nouveaux rounds jusqu'à `unpin`."""
+        self.get(version)
+        with self._locked():
+            pointer = self.pointer()
+            previous = pointer["version"] if pointer["version"] != version else pointer["previous"]
+            pointer = {"version": version, "pinned": True, "previous": previous}
+            self._write_pointer(pointer)
+        return pointer
+
+    def unpin(self) -> Dict:
+        """Revient à la dernière version enregistrée."""
+        with self._locked():
+            pointer = self.pointer()
+            versions = self.list_versions()
+            latest = versions[-1]["version"] if versions else None
+            previous = pointer["version"] if pointer["version"] != latest else pointer["previous"]
+            pointer = {"version": latest, "pinned": False, "previous": previous}
+            self._write_pointer(pointer)
+        return pointer
+
+    def rollback(self) -> Dict:
+        """Épingle la version précédente (celle servie avant la version courante)."""
+        pointer = self.pointer()
+        target = pointer["previous"]
+        if target is None or not os.path.isdir(self.version_dir(target)):
+            older = [v["version"] for v in self.list_versions() if pointer["version"] is None or v["version"] < pointer["version"]]
+            if not older:
+                raise KeyError("No previous model version to roll back to.")
+            target = older[-1]
+        return self.pin(target)
+
+    def prune(self, keep: int):
+        """Supprime les anciennes versions au-delà de `keep`, jamais la courante ni la précédente."""
+        if keep <= 0:
+            return
+        with self._locked():
+            pointer = self.pointer()
+            protected = {pointer["version"], pointer["previous"]}
+            for meta in self.list_versions()[:-keep]:
+                if meta["version"] not in protected:
+                    shutil.rmtree(self.version_dir(meta["version"]), ignore_errors=True)
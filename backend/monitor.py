@@ -7,6 +7,7 @@ import os
 import simpleaudio as sa
 from typing import Optional
 import argparse
+import threading
 
 # --- Configuration ---
 API_URL = "http://127.0.0.1:8000" # Sera mis à jour par l'argument --server-ip
@@ -119,25 +120,45 @@ def get_device_api_key(config_file: str) -> Optional[str]:
 
 # --- Classe Principale du Moniteur ---
 class Monitor:
+    # Durée maximale d'un long-poll côté serveur (le serveur la plafonne lui-même)
+    SETTINGS_WAIT = 50
+
     def __init__(self, api_key: str):
         self.api_key = api_key
         self.prevention_enabled = False
-        self.last_settings_check = 0
-
-    def check_settings(self):
-        if not self.api_key or (time.time() - self.last_settings_check < 60):
+        self.settings_etag: Optional[str] = None
+
+    def check_settings(self, wait: int = 0):
+        """
+        GET conditionnel (If-None-Match) des réglages.
+        Avec `wait` > 0, le serveur garde la requête ouverte et répond dès qu'un réglage change.
+        """
+        if not self.api_key:
             return
-        print("\n[Monitor] Checking for new prevention settings...")
-        self.last_settings_check = time.time()
-        try:
-            response = requests.get(f"{API_URL}/api/devices/{self.api_key}/settings", timeout=5)
-            if response.status_code == 200:
-                new_status = response.json().get("prevention_enabled", False)
-                if new_status != self.prevention_enabled:
-                    self.prevention_enabled = new_status
-                    print(f"  > ✅ Prevention Status is now: {'ENABLED' if self.prevention_enabled else 'DISABLED'}")
-        except requests.exceptions.RequestException:
-            print("  > ⚠️ Warning: Could not fetch settings from the backend server.")
+        headers = {"If-None-Match": self.settings_etag} if self.settings_etag else {}
+        response = requests.get(
+            f"{API_URL}/api/devices/{self.api_key}/settings",
+            params={"wait": wait},
+            headers=headers,
+            timeout=wait + 10,
+        )
+        if response.status_code == 200:
+            self.settings_etag = response.headers.get("ETag")
+            new_status = response.json().get("prevention_enabled", False)
+            if new_status != self.prevention_enabled:
+                self.prevention_enabled = new_status
+                print(f"  > ✅ Prevention Status is now: {'ENABLED' if self.prevention_enabled else 'DISABLED'}")
+        elif response.status_code != 304:
+            response.raise_for_status()
+
+    def watch_settings(self, stop_event: threading.Event):
+        """Thread : enchaîne les long-polls pour appliquer un changement en moins d'une seconde."""
+        while not stop_event.is_set():
+            try:
+                self.check_settings(wait=self.SETTINGS_WAIT)
+            except requests.exceptions.RequestException:
+                print("  > ⚠️ Warning: Could not fetch settings from the backend server.")
+                stop_event.wait(10)
 
     def run_prevention_action(self, ip: str, attack: str):
         print(f"   🔥 PREMIUM PREVENTION ACTION on {ip} 🔥")
@@ -150,10 +171,11 @@ class Monitor:
 
     def loop(self):
         print("\n--- Monitoring network traffic (Simulated)... Press Ctrl+C to stop. ---")
+        stop_event = threading.Event()
+        if self.api_key:
+            threading.Thread(target=self.watch_settings, args=(stop_event,), daemon=True).start()
         while True:
             try:
-                self.check_settings()
-                
                 if random.random() > 0.6: # 40% de chance de détecter une attaque
                     attack_type = random.choice(ATTACK_TYPES)
                     confidence = round(random.uniform(0.85, 1.0), 2)
@@ -180,6 +202,7 @@ class Monitor:
             except Exception as e:
                 print(f"\nAn unexpected error occurred in the monitor loop: {e}")
                 time.sleep(15)
+        stop_event.set()
         print("\nMonitor has been shut down.")
 
 # --- Fonction Principale ---
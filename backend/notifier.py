@@ -0,0 +1,149 @@
+# backend/notifier.py
+
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Dict
+
+import requests
+
+
+class DashboardNotifier:
+    """
+    Envoie les notifications du serveur Flower vers l'API FastAPI depuis un thread dédié.
+    `post` ne bloque jamais : la boucle d'entraînement n'attend pas le dashboard.
+
+    - file bornée en mémoire, session HTTP réutilisée (keep-alive)
+    - quelques essais avec backoff exponentiel par message
+    - messages `spool=True` que l'API n'a pas acceptés : ajoutés à un fichier JSONL,
+      rejoués dès que l'API répond de nouveau (y compris au prochain démarrage) ;
+      file pleine : mis de côté en mémoire, c'est le thread qui les écrit dans le spool
+    - messages `spool=False` (état "live", vite périmé) : abandonnés en cas d'échec
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        spool_path: str,
+        max_queue: int = 1000,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 5.0,
+        replay_interval: float = 30.0,
+    ):
+        self.api_url = api_url.rstrip("/")
+        self.spool_path = spool_path
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.replay_interval = replay_interval
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=max_queue)
+        # Messages `spool=True` refusés par la file pleine (deque.append ne bloque pas)
+        self._overflow: "deque[Dict[str, Any]]" = deque()
+        self._session = requests.Session()
+        self._spool_lock = threading.Lock()
+        self._stop = threading.Event()
+        # Après un échec, on n'essaie plus d'envoyer avant cette date (API considérée hors ligne)
+        self._down_until = 0.0
+        self._next_replay = 0.0
+        self._thread = threading.Thread(target=self._run, name="dashboard-notifier", daemon=True)
+        self.sent = 0
+        self.spooled = 0
+        self.dropped = 0
+
+    def start(self):
+        self._thread.start()
+
+    def post(self, path: str, payload: Any, spool: bool = True):
+        message = {"path": path, "payload": payload, "spool": spool}
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            # Pas d'écriture disque ici : on est sur le thread de la boucle d'entraînement
+            if spool:
+                self._overflow.append(message)
+            else:
+                self.dropped += 1
+
+    def close(self, timeout: float = 10.0):
+        """Vide la file (au plus `timeout` s) ; ce qui reste part dans le spool."""
+        self._stop.set()
+        self._thread.join(timeout)
+        self._spool_overflow()
+        while True:
+            try:
+                self._give_up(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._session.close()
+        print(f"📮 Dashboard notifier closed: {self.sent} sent, {self.spooled} spooled, {self.dropped} dropped.")
+
+    def _spool_overflow(self):
+        while True:
+            try:
+                self._give_up(self._overflow.popleft())
+            except IndexError:
+                break
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            self._spool_overflow()
+            try:
+                message = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                message = None
+            if message is not None:
+                if time.monotonic() < self._down_until or not self._send(message):
+                    self._give_up(message)
+            if time.monotonic() >= max(self._next_replay, self._down_until) and not self._stop.is_set():
+                self._next_replay = time.monotonic() + self.replay_interval
+                self._replay()
+
+    def _send(self, message: Dict[str, Any]) -> bool:
+        for attempt in range(self.retries):
+            try:
+                response = self._session.post(f"{self.api_url}{message['path']}", json=message["payload"], timeout=self.timeout)
+                if response.status_code < 500:
+                    if response.status_code >= 400:
+                        # Rejet définitif (payload invalide) : inutile de réessayer ou de spooler
+                        print(f"   -> ❌ Dashboard rejected {message['path']} ({response.status_code}): {response.text[:200]}")
+                    self.sent += 1
+                    return True
+            except requests.exceptions.RequestException:
+                pass
+            if attempt + 1 < self.retries and not self._stop.is_set():
+                time.sleep(self.backoff * 2 ** attempt)
+        print(f"   -> ❌ FAILED to reach dashboard for {message['path']}. Is uvicorn running?")
+        self._down_until = time.monotonic() + self.replay_interval
+        return False
+
+    def _give_up(self, message: Dict[str, Any]):
+        if not message.get("spool"):
+            self.dropped += 1
+            return
+        with self._spool_lock:
+            with open(self.spool_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(message) + "\n")
+        self.spooled += 1
+
+    def _replay(self):
+        """Rejoue le spool dans l'ordre ; s'arrête au premier échec et remet le reste en spool."""
+        replay_path = self.spool_path + ".replay"
+        with self._spool_lock:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spool_path):
+                    return
+                os.replace(self.spool_path, replay_path)
+        with open(replay_path, encoding="utf-8") as f:
+            pending = [json.loads(line) for line in f if line.strip()]
+        print(f"📮 Replaying {len(pending)} spooled dashboard notifications...")
+        for index, message in enumerate(pending):
+            if not self._send(message):
+                with self._spool_lock:
+                    with open(self.spool_path, "a", encoding="utf-8") as f:
+                        f.writelines(json.dumps(m) + "\n" for m in pending[index:])
+                break
+        os.unlink(replay_path)
@@ -0,0 +1,147 @@
+# backend/semi_sync.py
+
+import concurrent.futures
+import threading
+import time
+from functools import partial
+from typing import List, Optional, Tuple
+
+import flwr as fl
+from flwr.common import Code, FitRes
+from flwr.server.client_proxy import ClientProxy
+from flwr.server.server import fit_client
+
+
+class SemiSyncServer(fl.server.Server):
+    """
+    Round semi-synchrone : le round se ferme après `deadline` secondes ou dès `min_results`
+    réponses, sans attendre les clients lents (un Raspberry Pi ne bloque plus la fédération).
+
+    Chaque réponse est décodée et ajoutée à l'agrégation du round dès son arrivée, puis son
+    `FitRes` est libéré : avec `--aggregator mean`, la mémoire du round est O(modèle) au lieu de
+    O(clients x modèle). (Les agrégateurs robustes gardent par nature une ligne par client.)
+
+    Les clients coupés continuent leur entraînement en arrière-plan. Leur réponse est ajoutée
+    au round ouvert à son arrivée (à la FedBuff), avec le retard τ = round ouvert - round d'envoi :
+    la stratégie la pondère par (1 + τ)^-alpha. Seules les réponses arrivées entre deux rounds
+    (pendant l'évaluation) sont gardées en tampon jusqu'au round suivant. Au-delà de
+    `max_staleness` rounds, la mise à jour est abandonnée.
+
+    Sans `deadline` ni `min_results`, le round attend tous les clients : c'est le mode "sync"
+    de server.py, qui garde ainsi l'agrégation à l'arrivée.
+
+    Prévu pour FedIdsStrategy (busy_clients, begin_fit_aggregation, record_participation).
+    """
+
+    def __init__(self, *, client_manager, strategy, deadline: Optional[float] = None,
+                 min_results: int = 0, max_staleness: int = 2, max_workers: Optional[int] = None):
+        super().__init__(client_manager=client_manager, strategy=strategy)
+        self.deadline = deadline
+        self.min_results = min_results
+        self.max_staleness = max_staleness
+        # Pool gardé entre les rounds : les fits des retardataires survivent à la fin de leur round
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fit")
+        self._cond = threading.Condition()
+        self._busy = set()
+        # Réponses tardives arrivées alors qu'aucun round n'était ouvert
+        self._late: List[Tuple[ClientProxy, FitRes, int]] = []
+        # État du round ouvert (protégé par _cond)
+        self._open_round: Optional[int] = None
+        self._aggregation = None
+        self._arrived = 0
+        self._failures: List = []
+        self._late_folded = 0
+        self._expired = 0
+
+    def fit_round(self, server_round: int, timeout: Optional[float]):
+        started = time.monotonic()
+        instructions = self.strategy.configure_fit(
+            server_round=server_round, parameters=self.parameters, client_manager=self._client_manager
+        )
+        with self._cond:
+            self._busy.update(client.cid for client, _ in instructions)
+            self.strategy.busy_clients = frozenset(self._busy)
+            # Au plus : les clients de ce round, les retardataires encore en cours et le tampon
+            capacity = len(self._busy) + len(self._late)
+            self._open_round = server_round
+            self._aggregation = self.strategy.begin_fit_aggregation(server_round, capacity)
+            self._arrived, self._failures, self._late_folded, self._expired = 0, [], 0, 0
+            late, self._late = self._late, []
+            for client, fit_res, sent_round in late:
+                self._fold_late(client, fit_res, sent_round)
+            del late
+        for client, ins in instructions:
+            future = self._pool.submit(fit_client, client, ins, timeout)
+            future.add_done_callback(partial(self._on_fit_done, server_round, client))
+
+        deadline = started + self.deadline if self.deadline else None
+        with self._cond:
+            while self._arrived < len(instructions):
+                if self.min_results and self._aggregation.count - self._late_folded >= self.min_results:
+                    break
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self._open_round = None
+            aggregation, self._aggregation = self._aggregation, None
+            arrived, failures, late_folded, expired = self._arrived, self._failures, self._late_folded, self._expired
+
+        stragglers = len(instructions) - arrived
+        if not aggregation.count and not failures:
+            print(f"⏭️ Round {server_round}: no client update received, skipping aggregation.")
+            return None
+        print(f"⏱️ Round {server_round} closed after {time.monotonic() - started:.1f}s: {arrived}/{len(instructions)} clients answered, "
+              f"{late_folded} late updates folded in, {expired} too stale, {stragglers} still training.")
+
+        parameters_aggregated, metrics_aggregated = aggregation.finish(failures)
+        participation = {
+            "sampled": len(instructions),
+            "stragglers": stragglers,
+            "expired_updates": expired,
+            "round_duration": time.monotonic() - started,
+        }
+        self.strategy.record_participation(server_round, participation)
+        metrics_aggregated.update(participation)
+        # Les réponses sont déjà agrégées et libérées : rien à renvoyer pour l'historique Flower
+        return parameters_aggregated, metrics_aggregated, ([], failures)
+
+    def _fold_late(self, client: ClientProxy, fit_res: FitRes, sent_round: int):
+        """Appelé avec _cond tenu et un round ouvert."""
+        staleness = self._open_round - sent_round
+        if staleness > self.max_staleness:
+            self._expired += 1
+        elif self._aggregation.fold(client, fit_res, staleness):
+            self._late_folded += 1
+
+    def _on_fit_done(self, server_round: int, client: ClientProxy, future: concurrent.futures.Future):
+        if future.cancelled():
+            return
+        failure = future.exception()
+        with self._cond:
+            self._busy.discard(client.cid)
+            self.strategy.busy_clients = frozenset(self._busy)
+            if server_round == self._open_round:
+                self._arrived += 1
+                if failure is not None:
+                    self._failures.append(failure)
+                else:
+                    _, fit_res = future.result()
+                    if fit_res.status.code == Code.OK:
+                        self._aggregation.fold(client, fit_res)
+                    else:
+                        self._failures.append((client, fit_res))
+                self._cond.notify_all()
+            elif failure is None:
+                _, fit_res = future.result()
+                if fit_res.status.code != Code.OK:
+                    return
+                if self._open_round is not None:
+                    self._fold_late(client, fit_res, server_round)
+                else:
+                    self._late.append((client, fit_res, server_round))
+
+    def disconnect_all_clients(self, timeout: Optional[float]):
+        # Les entraînements encore en cours ne seront plus agrégés
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        super().disconnect_all_clients(timeout)
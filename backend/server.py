@@ -1,20 +1,26 @@
 # backend/server.py
 
 import flwr as fl
-import tensorflow as tf
-import requests
-from typing import List, Tuple, Optional, Dict, Union
-from flwr.common import Parameters, EvaluateRes, Scalar, ndarrays_to_parameters
+from typing import List, Tuple, Optional, Dict, Union, FrozenSet
+from flwr.common import Parameters, EvaluateRes, FitRes, Scalar, ndarrays_to_parameters, parameters_to_ndarrays
 from flwr.server.client_proxy import ClientProxy
-from flwr.server.strategy.aggregate import aggregate
 import time
 import os
 import argparse 
+import numpy as np
 from model_definition import create_model
+from notifier import DashboardNotifier
+from checkpoint import CheckpointWriter
+from model_registry import ModelRegistry
+from update_codec import decode_update
+from aggregation import AGGREGATORS, AggregationEngine
+from semi_sync import SemiSyncServer
 
 # --- Configuration ---
 # The URL of our FastAPI backend's API
 API_URL = "http://127.0.0.1:8000"
+# Notifications not delivered while the API is down are kept here and replayed later
+NOTIFIER_SPOOL = "dashboard_spool.jsonl"
 
 
 # --- Helper Function for Metric Aggregation ---
@@ -30,7 +36,10 @@ def weighted_average(metrics: List[Tuple[int, Dict[str, Scalar]]]) -> Dict[str,
     aggregated_metrics: Dict[str, Union[float, int]] = {}
     # Check if the metrics dictionary is not empty
     if metrics[0][1]:
-        for metric_name in metrics[0][1].keys():
+        for metric_name, value in metrics[0][1].items():
+            # Métriques non numériques (ex. le codec) : pas de moyenne possible
+            if isinstance(value, (str, bytes, bool)):
+                continue
             weighted_sum = sum(num_examples * m.get(metric_name, 0.0) for num_examples, m in metrics)
             aggregated_metrics[metric_name] = weighted_sum / num_total_examples
             
@@ -40,6 +49,54 @@ def weighted_average(metrics: List[Tuple[int, Dict[str, Scalar]]]) -> Dict[str,
 # --- Custom Flower Strategy ---
 
 class FedIdsStrategy(fl.server.strategy.FedAvg):
+    def __init__(self, *args, notifier: DashboardNotifier, checkpoints: CheckpointWriter,
+                 engine: AggregationEngine, max_staleness: int = 2, staleness_alpha: float = 0.5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.notifier = notifier
+        self.checkpoints = checkpoints
+        self.engine = engine
+        self.staleness_alpha = staleness_alpha
+        # Poids globaux gardés par round pour décoder les deltas, y compris ceux qui arrivent en retard
+        self.reference_rounds = max_staleness + 1
+        self.references: Dict[int, List[np.ndarray]] = {}
+        # Clients encore occupés par un round précédent (mode semi-synchrone) : pas de nouvelle instruction
+        self.busy_clients: FrozenSet[str] = frozenset()
+        # Participation / retard par round, envoyés avec /api/fl_update après l'évaluation
+        self.round_stats: Dict[int, Dict[str, Scalar]] = {}
+
+    def configure_fit(self, server_round, parameters, client_manager):
+        instructions = [(client, ins) for client, ins in super().configure_fit(server_round, parameters, client_manager)
+                        if client.cid not in self.busy_clients]
+        self.references[server_round] = parameters_to_ndarrays(parameters)
+        for old_round in [r for r in self.references if r <= server_round - self.reference_rounds]:
+            del self.references[old_round]
+        # Le client indique ce round comme `base_round` de son delta
+        for _, fit_ins in instructions:
+            fit_ins.config["server_round"] = server_round
+        return instructions
+
+    def configure_evaluate(self, server_round, parameters, client_manager):
+        return [(client, ins) for client, ins in super().configure_evaluate(server_round, parameters, client_manager)
+                if client.cid not in self.busy_clients]
+
+    def record_participation(self, server_round: int, stats: Dict[str, Scalar]):
+        self.round_stats.setdefault(server_round, {}).update(stats)
+
+    def staleness_weight(self, staleness: int) -> float:
+        """Poids d'une mise à jour calculée sur des poids vieux de `staleness` rounds : (1 + τ)^-alpha."""
+        return (1.0 + staleness) ** -self.staleness_alpha
+
+    def decode_fit_result(self, fit_res: FitRes) -> List[np.ndarray]:
+        """Poids complets d'un client (delta encodé reconstruit si besoin). ValueError si impossible."""
+        weights = parameters_to_ndarrays(fit_res.parameters)
+        codec = fit_res.metrics.get("codec")
+        if not codec:
+            return weights
+        reference = self.references.get(int(fit_res.metrics.get("base_round", -1)))
+        if reference is None:
+            raise ValueError(f"no reference weights for round {fit_res.metrics.get('base_round')}")
+        return decode_update(weights, reference, codec, float(fit_res.metrics.get("topk", 0.0)))
+
     def aggregate_evaluate(
         self,
         server_round: int,
@@ -48,47 +105,125 @@ class FedIdsStrategy(fl.server.strategy.FedAvg):
     ) -> Optional[Tuple[float, Dict[str, Scalar]]]:
         
         aggregated_loss, aggregated_metrics = super().aggregate_evaluate(server_round, results, failures)
+        for old_round in [r for r in self.round_stats if r < server_round]:
+            del self.round_stats[old_round]
         
         if aggregated_loss is not None and aggregated_metrics and "accuracy" in aggregated_metrics:
             accuracy = aggregated_metrics["accuracy"]
             print(f"✅ Round {server_round} COMPLETE. Global Accuracy: {accuracy:.4f}")
+            self.checkpoints.update_metrics(server_round, accuracy, aggregated_loss)
             
-            # === BLOC DE COMMUNICATION AMÉLIORÉ ===
-            try:
-                # On envoie la mise à jour pour le graphique en temps réel
-                requests.post(f"{API_URL}/api/fl_update", json={"server_round": server_round, "accuracy": accuracy,"loss": aggregated_loss}, timeout=5)
-                print("   -> ✅ Successfully notified dashboard of global status.")
-            except requests.exceptions.RequestException as e:
-                print(f"   -> ❌ FAILED to notify dashboard. Is uvicorn running? Error: {e}")
-
-            # On envoie l'historique détaillé pour la base de données
+            # Envoi en arrière-plan : le round suivant n'attend pas le dashboard.
+            # La mise à jour "live" du graphique n'a plus d'intérêt une fois périmée : pas de spool.
+            self.notifier.post("/api/fl_update", {"server_round": server_round, "accuracy": accuracy, "loss": aggregated_loss,
+                                                  **self.round_stats.get(server_round, {})}, spool=False)
+
+            # L'historique détaillé doit arriver en base, quitte à être rejoué plus tard (endpoint idempotent)
             history_payload = [{"client_flower_id": c.cid, "server_round": server_round, "accuracy": r.metrics.get("accuracy", 0.0), "loss": r.loss} for c, r in results]
             if history_payload:
-                try:
-                    requests.post(f"{API_URL}/api/admin/client_history", json=history_payload, timeout=5)
-                    print("   -> ✅ Successfully saved client history to database.")
-                except requests.exceptions.RequestException as e:
-                    print(f"   -> ❌ FAILED to save client history. Error: {e}")
+                self.notifier.post("/api/admin/client_history", history_payload)
         
         return aggregated_loss, aggregated_metrics
 
+    def begin_fit_aggregation(self, server_round: int, capacity: int) -> "FitAggregation":
+        """Agrégation d'un round alimentée client par client (voir FitAggregation)."""
+        return FitAggregation(self, server_round, capacity)
+
     def aggregate_fit(self, server_round, results, failures):
-        aggregated_parameters, aggregated_metrics = super().aggregate_fit(server_round, results, failures)
+        """
+        Avec `--aggregator mean`, même résultat que FedAvg.aggregate_fit. Utilisé seulement avec le
+        serveur Flower standard, qui a déjà reçu tous les `Parameters` : mémoire O(clients x modèle).
+        main() passe toujours par SemiSyncServer, qui ajoute chaque réponse à l'arrivée (O(modèle)).
+        """
+        aggregation = self.begin_fit_aggregation(server_round, len(results))
+        for client, fit_res in results:
+            aggregation.fold(client, fit_res)
+        return aggregation.finish(failures)
 
-        if aggregated_parameters is not None:
-            print(f"💾 Saving updated global model weights for round {server_round}...")
-            aggregated_ndarrays = fl.common.parameters_to_ndarrays(aggregated_parameters)
-            
-            # === LA CORRECTION EST ICI ===
-            # On ne charge pas un .h5 complet, on crée l'architecture et on y met les poids
-            temp_model = create_model()
-            temp_model.set_weights(aggregated_ndarrays)
-            
-            # On sauvegarde uniquement les poids
-            temp_model.save_weights("global_model.weights.h5")
-        
-        return aggregated_parameters, aggregated_metrics
 
+class FitAggregation:
+    """
+    Un round d'agrégation : `fold` décode une réponse, l'ajoute à l'accumulateur du moteur
+    (somme pondérée pour `mean`, matrice empilée pour les agrégateurs robustes) et ne garde
+    que ses métriques ; `finish` produit les paramètres globaux. Pas thread-safe : l'appelant sérialise.
+    """
+
+    def __init__(self, strategy: FedIdsStrategy, server_round: int, capacity: int):
+        self.strategy = strategy
+        self.server_round = server_round
+        self.accumulator = strategy.engine.new_round(max(capacity, 1))
+        self.fit_metrics: List[Tuple[int, Dict[str, Scalar]]] = []
+        self.clients: List[str] = []
+        self.stalenesses: List[int] = []
+        self.bytes_on_wire, self.bytes_raw = 0, 0
+        self.errors: List[float] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.clients)
+
+    def fold(self, client: ClientProxy, fit_res: FitRes, staleness: int = 0) -> bool:
+        """Ajoute la réponse d'un client. `staleness` : retard en rounds d'une réponse tardive."""
+        try:
+            weights = self.strategy.decode_fit_result(fit_res)
+            self.accumulator.add(weights, fit_res.num_examples * self.strategy.staleness_weight(staleness))
+        except ValueError as e:
+            print(f"   -> ❌ Dropping update from client {client.cid}: {e}")
+            return False
+        del weights
+        self.clients.append(client.cid)
+        self.stalenesses.append(staleness)
+        self.fit_metrics.append((fit_res.num_examples, fit_res.metrics))
+        wire = sum(len(tensor) for tensor in fit_res.parameters.tensors)
+        self.bytes_on_wire += wire
+        if fit_res.metrics.get("codec"):
+            self.bytes_raw += int(fit_res.metrics.get("bytes_raw", 0))
+            self.errors.append(float(fit_res.metrics.get("reconstruction_error", 0.0)))
+        else:
+            self.bytes_raw += wire
+        return True
+
+    def finish(self, failures) -> Tuple[Optional[Parameters], Dict[str, Scalar]]:
+        strategy, server_round = self.strategy, self.server_round
+        late = [s for s in self.stalenesses if s > 0]
+        strategy.record_participation(server_round, {
+            "participants": self.count,
+            "late_updates": len(late),
+            "failures": len(failures),
+            "mean_staleness": float(np.mean(self.stalenesses)) if self.stalenesses else 0.0,
+            "max_staleness": max(self.stalenesses, default=0),
+        })
+        if not strategy.accept_failures and failures:
+            return None, {}
+        if self.accumulator.total_weight <= 0:
+            print(f"⚠️ Round {server_round}: no usable client update, keeping the previous global model.")
+            return None, {}
+        try:
+            aggregated_ndarrays = self.accumulator.result()
+        except ValueError as e:
+            print(f"⚠️ Round {server_round}: {strategy.engine.method} aggregation failed ({e}), keeping the previous global model.")
+            return None, {}
+        if strategy.engine.method == "krum":
+            print(f"🛡️ Round {server_round}: Krum kept the update of client {self.clients[strategy.engine.last_selected]}.")
+
+        aggregated_metrics: Dict[str, Scalar] = {}
+        if strategy.fit_metrics_aggregation_fn:
+            aggregated_metrics = strategy.fit_metrics_aggregation_fn(self.fit_metrics)
+        aggregated_metrics.update({
+            "bytes_on_wire": self.bytes_on_wire,
+            "bytes_raw": self.bytes_raw,
+            "encoded_clients": len(self.errors),
+            "reconstruction_error": float(np.mean(self.errors)) if self.errors else 0.0,
+        })
+        print(f"📦 Round {server_round} uplink: {self.bytes_on_wire / 1024:.1f} KB on wire for {self.bytes_raw / 1024:.1f} KB of weights "
+              f"from {self.count} clients, mean reconstruction error {aggregated_metrics['reconstruction_error']:.2e}")
+        timings = {name[5:]: value for name, value in aggregated_metrics.items() if name.startswith("time_")}
+        if timings:
+            print(f"⏱️ Round {server_round} mean client fit timings: {', '.join(f'{name}={value:.3f}s' for name, value in timings.items())}")
+
+        # Poids bruts écrits en arrière-plan : pas de modèle Keras ni d'I/O sur le chemin du round
+        strategy.checkpoints.submit(server_round, aggregated_ndarrays)
+        return ndarrays_to_parameters(aggregated_ndarrays), aggregated_metrics
 
 
 # --- Main Execution Logic ---
@@ -96,41 +231,100 @@ class FedIdsStrategy(fl.server.strategy.FedAvg):
 def main():
     parser = argparse.ArgumentParser(description="Flower Server for FedIds")
     parser.add_argument("--num-clients", type=int, default=1, help="Minimum clients for training.")  # 1 par défaut en dev
+    parser.add_argument("--keep-checkpoints", type=int, default=5, help="Number of model versions to keep in the registry.")
+    parser.add_argument("--aggregator", choices=AGGREGATORS, default="mean", help="How client updates are combined (robust options resist poisoned updates).")
+    parser.add_argument("--trim-ratio", type=float, default=0.1, help="Fraction dropped at each end per coordinate (trimmed-mean).")
+    parser.add_argument("--krum-f", type=int, default=1, help="Number of malicious clients tolerated (krum).")
+    parser.add_argument("--round-mode", choices=("sync", "semi-sync"), default="sync",
+                        help="sync waits for every client; semi-sync closes a round at the deadline or after --min-results answers "
+                             "(late updates join the next round). Both fold updates as they arrive.")
+    parser.add_argument("--round-deadline", type=float, default=None, help="Seconds before a semi-sync round closes.")
+    parser.add_argument("--min-results", type=int, default=0, help="Close a semi-sync round after this many results (0: wait for all or the deadline).")
+    parser.add_argument("--staleness-alpha", type=float, default=0.5,
+                        help="Late updates are weighted by (1 + staleness)^-alpha (mean only: robust aggregators ignore weights).")
+    parser.add_argument("--max-staleness", type=int, default=2, help="Late updates older than this many rounds are dropped.")
+    parser.add_argument("--agg-threads", type=int, default=None, help="Threads for the aggregation kernels (default: CPU count).")
     
     args = parser.parse_args()
     
     print(f"🚀 Starting Flower Server... (waiting for {args.num_clients} clients)")
 
+    registry = ModelRegistry()
     try:
-        model = create_model()
-        if os.path.exists("global_model.weights.h5"):
-            model.load_weights("global_model.weights.h5")
-            print("✅ Initial model weights loaded successfully.")
+        current_version = registry.current()
+        if current_version is not None:
+            initial_weights = registry.load_weights(current_version)
+            print(f"✅ Initial model weights loaded from model version {current_version}.")
         else:
-            # Première exécution : on crée et sauvegarde des poids initiaux
-            model.save_weights("global_model.weights.h5")
-            print("⚠️ No weights found. Saved fresh initialized weights.")
-        initial_params = fl.common.ndarrays_to_parameters(model.get_weights())
+            model = create_model()
+            if os.path.exists("global_model.weights.h5"):
+                model.load_weights("global_model.weights.h5")
+                print("✅ Initial model weights loaded successfully.")
+            else:
+                print("⚠️ No weights found. Using fresh initialized weights.")
+            initial_weights = model.get_weights()
+            # Version "round 0" : l'API peut évaluer le modèle avant la fin du premier round
+            registry.register(0, initial_weights)
+        initial_params = fl.common.ndarrays_to_parameters(initial_weights)
     except Exception as e:
         print(f"❌ Could not prepare initial model weights. Error: {e}")
         return
   
+    try:
+        engine = AggregationEngine(args.aggregator, trim_ratio=args.trim_ratio, krum_f=args.krum_f, threads=args.agg_threads)
+    except ValueError as e:
+        print(f"❌ Invalid aggregation settings. Error: {e}")
+        return
+    print(f"🧮 Aggregator: {args.aggregator} ({engine.threads} threads)")
+    if args.aggregator != "mean" and args.round_mode == "semi-sync":
+        print(f"⚠️ {args.aggregator} ignores client weights: late updates are not down-weighted (only --max-staleness applies).")
+
+    notifier = DashboardNotifier(API_URL, NOTIFIER_SPOOL)
+    notifier.start()
+    checkpoints = CheckpointWriter(registry, keep=args.keep_checkpoints)
+    checkpoints.start()
+
     strategy = FedIdsStrategy(
+        notifier=notifier,
+        checkpoints=checkpoints,
+        engine=engine,
+        max_staleness=args.max_staleness,
+        staleness_alpha=args.staleness_alpha,
       initial_parameters=initial_params,
         min_fit_clients=args.num_clients,
         min_evaluate_clients=args.num_clients,
         min_available_clients=args.num_clients,
         evaluate_metrics_aggregation_fn=weighted_average,
+        fit_metrics_aggregation_fn=weighted_average,
     )
   
+    # Les deux modes agrègent chaque réponse dès son arrivée ; en "sync", sans échéance ni
+    # min_results, le round attend tous les clients comme le serveur Flower standard
+    semi_sync = args.round_mode == "semi-sync"
+    server = SemiSyncServer(
+        client_manager=fl.server.SimpleClientManager(),
+        strategy=strategy,
+        deadline=args.round_deadline if semi_sync else None,
+        min_results=args.min_results if semi_sync else 0,
+        max_staleness=args.max_staleness,
+    )
+    if semi_sync:
+        print(f"⏱️ Semi-synchronous rounds: deadline {args.round_deadline}s, closing after {args.min_results or 'all'} results.")
+
     print("Waiting 5s for FastAPI backend...")
     time.sleep(5)
     
-    fl.server.start_server(
-        server_address="0.0.0.0:8080",
-        config=fl.server.ServerConfig(num_rounds=10),
-        strategy=strategy
-    )
+    try:
+        fl.server.start_server(
+            server_address="0.0.0.0:8080",
+            config=fl.server.ServerConfig(num_rounds=10),
+            server=server,
+            strategy=strategy
+        )
+    finally:
+        checkpoints.close()
+        notifier.close()
+        engine.close()
     print("✅ Federated Learning process complete.")
 
 if __name__ == "__main__":
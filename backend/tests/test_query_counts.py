@@ -0,0 +1,131 @@
+# backend/tests/test_query_counts.py
+#
+# Les listes admin / appareils doivent émettre un nombre CONSTANT de requêtes SQL,
+# quel que soit le nombre de lignes (pas de N+1).
+
+import os
+import sys
+from contextlib import contextmanager
+
+import pytest
+
+# main.py lit sa configuration à l'import
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+for name, value in {"MAIL_USERNAME": "test", "MAIL_PASSWORD": "test", "MAIL_FROM": "test@fedids.io", "MAIL_SERVER": "localhost"}.items():
+    os.environ.setdefault(name, value)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import main
+from main import Device, DeviceCategory, DeviceStatus, Payment, User
+
+
+@pytest.fixture
+def db_session():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    main.Base.metadata.create_all(bind=engine)
+    TestingSession = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    session = TestingSession()
+    session.engine = engine
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def client(db_session):
+    def get_test_db():
+        db = sessionmaker(autocommit=False, autoflush=False, bind=db_session.engine)()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    main.app.dependency_overrides[main.get_db] = get_test_db
+    yield TestClient(main.app)
+    main.app.dependency_overrides.clear()
+
+
+def login_as(user: User):
+    # Pas de requête d'authentification : seules celles de l'endpoint sont comptées
+    main.app.dependency_overrides[main.get_current_user] = lambda: user
+    main.app.dependency_overrides[main.get_current_admin_user] = lambda: user
+
+
+@contextmanager
+def count_statements(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def seed(db, rows: int):
+    """Un admin + `rows` utilisateurs, chacun avec `rows` appareils (catégorie propre, statut) et paiements."""
+    admin = User(email="admin@fedids.io", username="admin", role="admin", is_active=True)
+    db.add(admin)
+    db.flush()
+    owner = None
+    for i in range(rows):
+        user = User(email=f"user{i}@fedids.io", username=f"user{i}", is_active=True)
+        db.add(user)
+        db.flush()
+        owner = owner or user
+        for j in range(rows):
+            category = DeviceCategory(name=f"cat{i}-{j}", owner_id=user.id)
+            db.add(category)
+            db.flush()
+            device = Device(name=f"device{i}-{j}", owner_id=user.id, category_id=category.id, prevention_enabled=j % 2 == 0)
+            db.add(device)
+            db.flush()
+            db.add(DeviceStatus(device_api_key=device.api_key, status="online"))
+            db.add(Payment(user_id=user.id, stripe_payment_intent_id=f"pi_{i}_{j}", amount=100, currency="eur", status="succeeded"))
+    db.commit()
+    # Recharge les attributs expirés par le commit, hors du comptage
+    db.refresh(admin)
+    db.refresh(owner)
+    return admin, owner
+
+
+def statements_for(client, db, rows: int, path_for):
+    admin, owner = seed(db, rows)
+    login_as(owner if "my-devices" in path_for(owner) else admin)
+    with count_statements(db.engine) as statements:
+        response = client.get(path_for(owner))
+    assert response.status_code == 200, response.text
+    return len(statements), response
+
+
+@pytest.mark.parametrize("path_for, expected", [
+    # COUNT(*) pour X-Total-Count + la liste avec ses compteurs agrégés
+    (lambda owner: "/api/admin/users", 2),
+    # existence de l'utilisateur + appareils/statuts + catégories (selectinload)
+    (lambda owner: f"/api/admin/users/{owner.id}/devices", 3),
+    # appareils/statuts + catégories (selectinload)
+    (lambda owner: "/api/devices/my-devices-with-status", 2),
+])
+@pytest.mark.parametrize("rows", [1, 8])
+def test_constant_statement_count(client, db_session, path_for, expected, rows):
+    count, response = statements_for(client, db_session, rows, path_for)
+    assert count == expected
+    assert len(response.json()) >= 1
+
+
+def test_lists_are_not_truncated_without_limit(client, db_session):
+    admin, owner = seed(db_session, 3)
+    login_as(admin)
+    assert len(client.get("/api/admin/users").json()) == 4
+    assert len(client.get("/api/admin/users?limit=2").json()) == 2
+    login_as(owner)
+    assert len(client.get("/api/devices/my-devices-with-status").json()) == 3
+    assert len(client.get("/api/devices/my-devices-with-status?skip=1").json()) == 2
@@ -0,0 +1,82 @@
+# backend/tests/test_rollup_retention.py
+#
+# Les rollups sont le seul historique des logs supprimés par la rétention :
+# un backfill lancé ensuite ne doit pas les effacer.
+
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+# main.py lit sa configuration à l'import
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+for name, value in {"MAIL_USERNAME": "test", "MAIL_PASSWORD": "test", "MAIL_FROM": "test@fedids.io", "MAIL_SERVER": "localhost"}.items():
+    os.environ.setdefault(name, value)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import attack_retention
+import backfill_rollups
+import main
+from main import AttackLog, AttackRollup
+
+
+@pytest.fixture
+def session_factory(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    main.Base.metadata.create_all(bind=engine)
+    TestingSession = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    monkeypatch.setattr(backfill_rollups, "SessionLocal", TestingSession)
+    yield TestingSession
+    engine.dispose()
+
+
+def rollup_total(db, since=None):
+    query = db.query(func.coalesce(func.sum(AttackRollup.count), 0))
+    if since:
+        query = query.filter(AttackRollup.bucket >= since)
+    return int(query.scalar())
+
+
+def test_backfill_after_retention_keeps_compacted_history(session_factory):
+    now = datetime.utcnow()
+    old, recent = now - timedelta(days=120), now - timedelta(days=2)
+    db = session_factory()
+    for i in range(5):
+        db.add(AttackLog(device_api_key="dev-a", attack_type="DDoS", timestamp=old + timedelta(minutes=i)))
+    for i in range(3):
+        db.add(AttackLog(device_api_key="dev-a", attack_type="PortScan", timestamp=recent + timedelta(minutes=i)))
+    db.commit()
+
+    deleted = attack_retention.delete_expired_rows(db, now - timedelta(days=90), None)
+    assert deleted == 5
+    assert db.query(AttackLog).count() == 3
+    main.rebuild_attack_rollups(db, since=recent)
+    db.commit()
+    assert rollup_total(db) == 8
+
+    backfill_rollups.backfill_rollups()
+
+    db.expire_all()
+    assert rollup_total(db) == 8
+    assert rollup_total(db, since=main.hour_bucket(recent)) == 3
+    db.close()
+
+
+def test_backfill_without_logs_keeps_rollups(session_factory):
+    db = session_factory()
+    main.upsert_attack_rollups(db, [{
+        "device_api_key": "dev-a", "attack_type": "DDoS", "bucket": main.hour_bucket(datetime.utcnow() - timedelta(days=200)),
+        "count": 4, "last_seen": datetime.utcnow() - timedelta(days=200),
+    }])
+    db.commit()
+
+    backfill_rollups.backfill_rollups()
+
+    db.expire_all()
+    assert rollup_total(db) == 4
+    db.close()
@@ -0,0 +1,118 @@
+# backend/update_codec.py
+#
+# Compression des mises à jour envoyées par les clients Flower.
+# Le client envoie delta = poids_locaux - poids_globaux_du_round au lieu des poids complets,
+# éventuellement quantifié (float16 / int8) et creusé (top-k). Le serveur connaît les poids
+# globaux du round (`base_round`) et reconstruit les poids avant l'agrégation.
+#
+# Format : une liste plate de ndarrays (transportable tel quel par Flower), par tenseur :
+#   dense  fp32/fp16 : [valeurs]              dense  int8 : [valeurs int8, échelle]
+#   top-k  fp32/fp16 : [indices, valeurs]     top-k  int8 : [indices, valeurs int8, échelle]
+# Les tenseurs non flottants sont envoyés tels quels : [valeurs].
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+CODECS = ("fp32", "fp16", "int8")
+
+
+def ndarrays_nbytes(arrays: List[np.ndarray]) -> int:
+    return int(sum(a.nbytes for a in arrays))
+
+
+def _quantize(values: np.ndarray, codec: str) -> List[np.ndarray]:
+    if codec == "fp32":
+        return [values.astype(np.float32)]
+    if codec == "fp16":
+        return [values.astype(np.float16)]
+    peak = float(np.max(np.abs(values))) if values.size else 0.0
+    scale = peak / 127.0 if peak > 0 else 1.0
+    return [np.clip(np.rint(values / scale), -127, 127).astype(np.int8), np.array([scale], dtype=np.float32)]
+
+
+def _dequantize(parts: List[np.ndarray], codec: str) -> np.ndarray:
+    if codec == "int8":
+        return parts[0].astype(np.float32) * parts[1][0]
+    return parts[0].astype(np.float32)
+
+
+def _parts_per_tensor(codec: str, topk: float) -> int:
+    return (2 if codec == "int8" else 1) + (1 if topk > 0 else 0)
+
+
+def encode_tensor(delta: np.ndarray, codec: str, topk: float) -> List[np.ndarray]:
+    flat = delta.ravel()
+    if topk > 0:
+        k = max(1, int(np.ceil(topk * flat.size)))
+        indices = np.argpartition(np.abs(flat), -k)[-k:].astype(np.int32) if k < flat.size else np.arange(flat.size, dtype=np.int32)
+        return [indices] + _quantize(flat[indices], codec)
+    return _quantize(delta, codec)
+
+
+def decode_tensor(parts: List[np.ndarray], shape: Tuple[int, ...], codec: str, topk: float) -> np.ndarray:
+    if topk > 0:
+        flat = np.zeros(int(np.prod(shape)), dtype=np.float32)
+        flat[parts[0]] = _dequantize(parts[1:], codec)
+        return flat.reshape(shape)
+    return _dequantize(parts, codec).reshape(shape)
+
+
+def decode_update(encoded: List[np.ndarray], reference: List[np.ndarray], codec: str, topk: float = 0.0) -> List[np.ndarray]:
+    """Reconstruit les poids complets à partir du delta encodé et des poids globaux du round."""
+    weights, position = [], 0
+    parts_per_tensor = _parts_per_tensor(codec, topk)
+    for base in reference:
+        if not np.issubdtype(base.dtype, np.floating):
+            weights.append(encoded[position])
+            position += 1
+            continue
+        delta = decode_tensor(encoded[position:position + parts_per_tensor], base.shape, codec, topk)
+        weights.append((base.astype(np.float32) + delta).astype(base.dtype))
+        position += parts_per_tensor
+    if position != len(encoded):
+        raise ValueError(f"Encoded update has {len(encoded)} arrays, expected {position} for codec '{codec}'.")
+    return weights
+
+
+class UpdateEncoder:
+    """
+    Encodeur côté client. Avec top-k ou la quantification, ce qui n'a pas été transmis
+    (résidu) est ajouté au delta du round suivant (error feedback), pour ne rien perdre.
+    """
+
+    def __init__(self, codec: str, topk: float = 0.0, error_feedback: bool = True):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown update codec '{codec}' (expected one of {', '.join(CODECS)}).")
+        self.codec = codec
+        self.topk = topk
+        self.error_feedback = error_feedback
+        self._residuals: Optional[List[np.ndarray]] = None
+
+    def encode(self, weights: List[np.ndarray], reference: List[np.ndarray]) -> Tuple[List[np.ndarray], Dict]:
+        encoded, error_sq, norm_sq, residuals = [], 0.0, 0.0, []
+        for i, (w, base) in enumerate(zip(weights, reference)):
+            if not np.issubdtype(base.dtype, np.floating):
+                encoded.append(w)
+                residuals.append(None)
+                continue
+            delta = w.astype(np.float32) - base.astype(np.float32)
+            if self._residuals is not None and self._residuals[i] is not None:
+                delta += self._residuals[i]
+            parts = encode_tensor(delta, self.codec, self.topk)
+            sent = decode_tensor(parts, delta.shape, self.codec, self.topk)
+            residual = delta - sent
+            residuals.append(residual if self.error_feedback else None)
+            error_sq += float(np.sum(residual ** 2))
+            norm_sq += float(np.sum(delta ** 2))
+            encoded.extend(parts)
+        self._residuals = residuals
+        metrics = {
+            "codec": self.codec,
+            "topk": float(self.topk),
+            "bytes_raw": ndarrays_nbytes(weights),
+            "bytes_encoded": ndarrays_nbytes(encoded),
+            # Erreur relative (L2) entre le delta voulu et le delta reconstruit par le serveur
+            "reconstruction_error": float(np.sqrt(error_sq / norm_sq)) if norm_sq > 0 else 0.0,
+        }
+        return encoded, metrics
@@ -0,0 +1,160 @@
+# backend/ws_broker.py
+import asyncio
+import glob
+import json
+import os
+import socket
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# deliver(channel, message, device_api_key, event) : diffusion locale du ConnectionManager
+Deliver = Callable[[str, str, Optional[str], Optional[Dict]], Awaitable[None]]
+
+
+class Broker:
+    """
+    Interface de diffusion entre workers uvicorn.
+    `publish` doit faire arriver le message au `deliver` de CHAQUE worker (y compris le sien).
+    """
+
+    async def start(self, deliver: Deliver):
+        raise NotImplementedError
+
+    async def publish(self, channel: str, msg: str, device_api_key: Optional[str] = None, event: Optional[Dict] = None):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def stats(self) -> Dict:
+        return {"backend": type(self).__name__}
+
+
+class InMemoryBroker(Broker):
+    """Un seul processus : on délivre directement."""
+
+    def __init__(self):
+        self._deliver: Optional[Deliver] = None
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+
+    async def publish(self, channel: str, msg: str, device_api_key: Optional[str] = None, event: Optional[Dict] = None):
+        if self._deliver:
+            await self._deliver(channel, msg, device_api_key, event)
+
+
+class UnixSocketBroker(Broker):
+    """
+    Diffusion entre workers d'une même machine sans service externe.
+    Chaque worker lie un socket datagramme Unix `worker-<pid>.sock` dans `directory` ;
+    `publish` délivre localement puis envoie un datagramme à chaque autre worker.
+    Les sockets de workers morts sont supprimés au premier envoi refusé.
+    """
+
+    MAX_DATAGRAM = 64 * 1024
+    PEER_REFRESH = 1.0  # secondes entre deux relectures du répertoire
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, f"worker-{os.getpid()}.sock")
+        self._sock: Optional[socket.socket] = None
+        self._deliver: Optional[Deliver] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._peers: List[str] = []
+        self._peers_at = 0.0
+        self._tasks: set = set()
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+        self._loop = asyncio.get_running_loop()
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._sock.setblocking(False)
+        self._loop.add_reader(self._sock.fileno(), self._on_readable)
+
+    async def close(self):
+        if self._sock is None:
+            return
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    async def publish(self, channel: str, msg: str, device_api_key: Optional[str] = None, event: Optional[Dict] = None):
+        if self._sock is None:
+            raise RuntimeError("UnixSocketBroker.publish() called before start() (or after close()).")
+        await self._deliver(channel, msg, device_api_key, event)
+        data = json.dumps({"c": channel, "m": msg, "k": device_api_key, "e": event}).encode("utf-8")
+        if len(data) > self.MAX_DATAGRAM:
+            print(f"⚠️ [Broker] Message on '{channel}' too large for IPC ({len(data)} bytes), delivered locally only.")
+            self.dropped += 1
+            return
+        for peer in list(self._get_peers()):
+            try:
+                self._sock.sendto(data, peer)
+                self.sent += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Worker arrêté sans nettoyer son socket
+                self._forget_peer(peer)
+            except BlockingIOError:
+                # File du worker pair pleine : on préfère perdre un message que bloquer la boucle
+                self.dropped += 1
+
+    def _get_peers(self) -> List[str]:
+        now = time.monotonic()
+        if now - self._peers_at > self.PEER_REFRESH:
+            pattern = os.path.join(self.directory, "worker-*.sock")
+            self._peers = [p for p in glob.glob(pattern) if p != self.path]
+            self._peers_at = now
+        return self._peers
+
+    def _forget_peer(self, peer: str):
+        if peer in self._peers:
+            self._peers.remove(peer)
+        try:
+            os.unlink(peer)
+        except OSError:
+            pass
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self._sock.recv(self.MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                message = json.loads(data)
+            except ValueError:
+                continue
+            self.received += 1
+            task = self._loop.create_task(self._deliver(message["c"], message["m"], message.get("k"), message.get("e")))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> Dict:
+        return {
+            "backend": type(self).__name__,
+            "path": self.path,
+            "peers": len(self._get_peers()) if self._sock else 0,
+            "sent": self.sent,
+            "received": self.received,
+            "dropped": self.dropped,
+        }
+
+
+def create_broker(kind: str, directory: str) -> Broker:
+    if kind == "unix":
+        return UnixSocketBroker(directory)
+    if kind == "memory":
+        return InMemoryBroker()
+    raise ValueError(f"Unknown WS_BROKER '{kind}' (expected 'memory' or 'unix').")